@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import date, timedelta
+from collections import deque
+
+import run
+
+
+# Each scale is the number of rows of orders and items, customer gets a tenth of them
+default_scales = [1000, 10000, 100000]
+
+# Data and query parameters are drawn from a generator seeded with this, so runs are comparable
+default_seed = 42
+
+# Rows of one statement of the bulk insert workload
+bulk_insert_batch_size = 1000
+
+# Full scans and joins run this many times, filters and deletes run this many statements
+scan_repeats = 3
+join_repeats = 3
+filter_queries = 20
+delete_statements = 50
+
+# Rows of amount are in [0, amount_range), a selective filter reads one percent of it
+amount_range = 10000
+filter_width = amount_range // 100
+
+# Compared with a baseline, a workload whose throughput drops by more than this fraction is a regression
+regression_threshold = 0.1
+
+first_date = date(2000, 1, 1)
+cities = ['seoul', 'busan', 'incheon', 'daegu', 'daejeon', 'gwangju', 'ulsan', 'suwon']
+
+schema_statements = [
+    "create table customer (id int not null, name char(20), city char(10), joined date, primary key (id))",
+    "create table orders (id int not null, customer_id int, amount int, ordered date, primary key (id), "
+    "foreign key (customer_id) references customer (id))",
+    "create table items (id int not null, order_id int, qty int, primary key (id), "
+    "foreign key (order_id) references orders (id))",
+    "create index items_order on items (order_id)",
+]
+
+full_scan_query = "select * from orders"
+filter_query = "select id, amount from orders where amount >= ? and amount < ?"
+join2_query = "select customer.name, orders.amount from customer, orders where customer.id = orders.customer_id"
+join3_query = ("select customer.city, orders.ordered, items.qty from customer, orders, items "
+               "where customer.id = orders.customer_id and orders.id = items.order_id")
+delete_query = "delete from items where order_id >= ? and order_id < ?"
+
+
+def generate_tables(rng, scale):
+    # Return rows of customer, orders and items, referencing rows of the previous table
+    customer_count = max(scale // 10, 1)
+    customers = [(i, f"customer{i}", rng.choice(cities), first_date + timedelta(days=rng.randrange(7000)))
+                 for i in range(1, customer_count + 1)]
+    orders = [(i, rng.randint(1, customer_count), rng.randrange(amount_range), first_date + timedelta(days=rng.randrange(9000)))
+              for i in range(1, scale + 1)]
+    items = [(i, rng.randint(1, scale), rng.randint(1, 20)) for i in range(1, scale + 1)]
+    return customers, orders, items
+
+
+def timed(samples, function, *arguments):
+    # Run function, append its latency in seconds to samples and return what it returned
+    start = time.perf_counter()
+    value = function(*arguments)
+    samples.append(time.perf_counter() - start)
+    return value
+
+
+def read_all(cursor, statement, parameters=None):
+    # Execute statement and read its rows without keeping them, return the number of rows
+    cursor.execute(statement, parameters)
+    counter = deque(enumerate(cursor, 1), maxlen=1)
+    return counter[0][0] if counter else 0
+
+
+def changed_rows(cursor, statement, parameters=None):
+    return cursor.execute(statement, parameters).rowcount
+
+
+def percentile(sorted_samples, fraction):
+    # Nearest rank percentile of sorted samples
+    if not sorted_samples:
+        return 0.0
+    rank = max(int(fraction * len(sorted_samples) + 0.999999) - 1, 0)
+    return sorted_samples[min(rank, len(sorted_samples) - 1)]
+
+
+def summarize(workload, scale, samples, rows):
+    # Throughput is rows inserted, read or deleted per second, latency is of one statement
+    seconds = sum(samples)
+    samples = sorted(samples)
+    return {
+        'workload': workload,
+        'scale': scale,
+        'statements': len(samples),
+        'rows': rows,
+        'seconds': round(seconds, 6),
+        'rows_per_second': round(rows / seconds, 3) if seconds else None,
+        'statements_per_second': round(len(samples) / seconds, 3) if seconds else None,
+        'latency_ms': {
+            'mean': round(seconds / len(samples) * 1000, 4) if samples else 0.0,
+            'p50': round(percentile(samples, 0.5) * 1000, 4),
+            'p90': round(percentile(samples, 0.9) * 1000, 4),
+            'p99': round(percentile(samples, 0.99) * 1000, 4),
+            'max': round(samples[-1] * 1000, 4) if samples else 0.0,
+        },
+    }
+
+
+def run_scale(scale, seed, workloads, log):
+    # Run the workloads on a new database holding generated tables of the scale, return their summaries.
+    # Workloads run in order, later ones read the tables loaded by the inserts
+    rng = random.Random(f"{seed}:{scale}")
+    customers, orders, items = generate_tables(rng, scale)
+    results = []
+
+    def record(workload, samples, rows):
+        if workload in workloads:
+            results.append(summarize(workload, scale, samples, rows))
+            log(f"{workload:>14} scale={scale:<8} {results[-1]['rows_per_second']} rows/s, p50 {results[-1]['latency_ms']['p50']} ms")
+
+    with run.connect() as connection:
+        cursor = connection.cursor()
+        for statement in schema_statements:
+            cursor.execute(statement)
+
+        # Customers are inserted one statement each, orders and items by statements of many rows
+        samples = []
+        insert_customer = connection.prepare("insert into customer values (?, ?, ?, ?)")
+        for row in customers:
+            timed(samples, changed_rows, cursor, insert_customer, row)
+        record('single_insert', samples, len(customers))
+
+        samples, inserted = [], 0
+        for table_name, rows, width in [('orders', orders, 4), ('items', items, 3)]:
+            placeholders = '(' + ', '.join(['?'] * width) + ')'
+            for start in range(0, len(rows), bulk_insert_batch_size):
+                batch = rows[start:start + bulk_insert_batch_size]
+                text = f"insert into {table_name} values " + ', '.join([placeholders] * len(batch))
+                inserted += timed(samples, changed_rows, cursor, text, [value for row in batch for value in row])
+        record('bulk_insert', samples, inserted)
+
+        if 'full_scan' in workloads:
+            samples, read = [], 0
+            for _ in range(scan_repeats):
+                read += timed(samples, read_all, cursor, full_scan_query)
+            record('full_scan', samples, read)
+
+        if 'filter' in workloads:
+            samples, read = [], 0
+            for _ in range(filter_queries):
+                lower = rng.randrange(amount_range - filter_width)
+                read += timed(samples, read_all, cursor, filter_query, [lower, lower + filter_width])
+            record('filter', samples, read)
+
+        for workload, query in [('join2', join2_query), ('join3', join3_query)]:
+            if workload in workloads:
+                samples, read = [], 0
+                for _ in range(join_repeats):
+                    read += timed(samples, read_all, cursor, query)
+                record(workload, samples, read)
+
+        # Each delete removes items of a disjoint range of orders, so all of them are gone at the end
+        if 'delete' in workloads:
+            samples, deleted = [], 0
+            bounds = [1 + scale * i // delete_statements for i in range(delete_statements + 1)]
+            ranges = list(zip(bounds, bounds[1:]))
+            rng.shuffle(ranges)
+            for lower, upper in ranges:
+                deleted += timed(samples, changed_rows, cursor, delete_query, [lower, upper])
+            record('delete', samples, deleted)
+    return results
+
+
+def environment():
+    # Where the results were measured, so that a baseline from another machine can be recognized
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': run.numpy is not None,
+        'commit': commit,
+    }
+
+
+def compare(results, baseline, threshold, log):
+    # Print change of throughput and median latency of each workload found in both, return the regressions
+    baseline_results = {(result['workload'], result['scale']): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = baseline_results.get((result['workload'], result['scale']))
+        if old is None or not old['rows_per_second'] or not result['rows_per_second']:
+            continue
+        change = result['rows_per_second'] / old['rows_per_second'] - 1
+        verdict = ''
+        if change < -threshold:
+            verdict = '  REGRESSION'
+            regressions.append(result)
+        log(f"{result['workload']:>14} scale={result['scale']:<8} {old['rows_per_second']} -> {result['rows_per_second']} rows/s "
+            f"({change:+.1%}), p50 {old['latency_ms']['p50']} -> {result['latency_ms']['p50']} ms{verdict}")
+    return regressions
+
+
+workload_names = ['single_insert', 'bulk_insert', 'full_scan', 'filter', 'join2', 'join3', 'delete']
+
+
+def main():
+    arguments = argparse.ArgumentParser(description="Benchmark of my_dbms workloads on generated tables")
+    arguments.add_argument('--scales', type=lambda text: [int(scale) for scale in text.split(',')], default=default_scales,
+                           help="comma separated numbers of rows, e.g. 1000,10000,100000,1000000")
+    arguments.add_argument('--seed', type=int, default=default_seed)
+    arguments.add_argument('--workloads', type=lambda text: text.split(','), default=workload_names,
+                           help="comma separated subset of " + ','.join(workload_names))
+    arguments.add_argument('--output', help="file to write results to as JSON, standard output when left out")
+    arguments.add_argument('--baseline', help="JSON results to compare with, exit status is 1 on a regression")
+    arguments.add_argument('--compare', help="compare these saved JSON results with the baseline instead of running")
+    arguments.add_argument('--threshold', type=float, default=regression_threshold)
+    arguments.add_argument('--keep', action='store_true', help="keep the database directories of the runs")
+    options = arguments.parse_args()
+    log = lambda line: print(line, file=sys.stderr)
+
+    unknown = set(options.workloads) - set(workload_names)
+    if unknown:
+        arguments.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+    if options.compare and not options.baseline:
+        arguments.error("--compare needs --baseline")
+
+    if options.compare:
+        with open(options.compare) as file:
+            results = json.load(file)
+    else:
+        results = {'seed': options.seed, 'scales': options.scales, 'environment': environment(), 'results': []}
+        home = os.getcwd()
+        for scale in options.scales:
+            # Database of each scale is created in DB directory of a new working directory
+            directory = tempfile.mkdtemp(prefix=f'my_dbms_bench_{scale}_')
+            os.mkdir(os.path.join(directory, 'DB'))
+            os.chdir(directory)
+            try:
+                results['results'] += run_scale(scale, options.seed, options.workloads, log)
+            finally:
+                os.chdir(home)
+                if options.keep:
+                    log(f"database of scale {scale} is kept in {directory}")
+                else:
+                    shutil.rmtree(directory, ignore_errors=True)
+        if options.output:
+            with open(options.output, 'w') as file:
+                json.dump(results, file, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('seed') != results.get('seed'):
+            log(f"baseline was generated with seed {baseline.get('seed')}, results with seed {results.get('seed')}")
+        if compare(results, baseline, options.threshold, log):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
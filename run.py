@@ -1,17 +1,183 @@
+import io
 import os
+import re
+import sys
+import csv
+import time
+import copy
+import json
+import heapq
+import random
+import bisect
+import struct
+import hashlib
+import pickle
+import shutil
+import asyncio
+import weakref
+import argparse
+import operator
+import tempfile
+import threading
+import multiprocessing
 from glob import glob
-from lark import Lark, Transformer, exceptions
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import date, datetime
+from itertools import chain, islice, combinations
+from collections import OrderedDict, deque
+from lark import Lark, Transformer, Tree, Token, exceptions
 from berkeleydb import db
 
+# NumPy is optional, scans filter row by row without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 prompt_msg = "MY_DB> "
 
+# Analyzed LALR tables of grammar.lark are kept in this file, it is rebuilt when the grammar changes
+parser_cache_path = 'grammar.cache'
+
+# Parsed statements and their plans are kept for this many distinct statement texts
+statement_cache_size = 256
+
+# Hash join keeps build side in memory up to this many bytes, then spills into partitions
+hash_join_memory_budget = 64 * 1024 * 1024
+grace_partition_count = 16
+
+# Char values are stored with a 2 byte length, so char(n) and utf-8 bytes of a value are limited to this
+max_char_length = 65535
+
+# Version of table file layout, older tables are migrated at startup
+storage_format_version = '3'
+
+# Table and index files kept open across statements, least recently used ones are closed over this
+max_open_files = 64
+
+# Table and index files live in a transactional environment sharing one buffer pool of cache_size bytes.
+# sync_policy decides when the log of committed transactions is written to disk, that is which commits
+# survive a crash of the process or the machine:
+# 'sync' on every commit, before the commit returns.
+# 'group' once for many commits. The REPL writes the log before reading the next input line and the server
+# before replying to a statement, so a commit they report is on disk. Commits of the Python API are written
+# after group_commit_size commits or within group_commit_interval seconds, a crash loses at most those.
+# 'nosync' only at exit, a crash loses every commit since the database was opened
+cache_size = 64 * 1024 * 1024
+sync_policy = 'group'
+group_commit_size = 1000
+group_commit_interval = 0.05
+
+# A transaction holds a lock on every page it writes, so bulk loads need a large lock table
+max_locks = 100000
+
+# LOAD DATA converts and writes rows in batches of this many rows
+load_batch_size = 10000
+
+# Scans of tables larger than parallel_scan_min_size bytes are split into key ranges, which are
+# decoded and filtered by scan_parallelism worker processes. 1 scans in the statement's own thread
+scan_parallelism = os.cpu_count() or 1
+parallel_scan_min_size = 64 * 1024 * 1024
+
+# ANALYZE builds histograms of histogram_buckets equal-depth buckets from a sample of statistics_sample_size rows,
+# and estimates distinct values of a column from its distinct_sketch_size smallest hashes
+histogram_buckets = 32
+statistics_sample_size = 30000
+distinct_sketch_size = 1024
+
+# With statistics, secondary index is used when it is estimated to return at most this fraction of the rows,
+# and joins of up to join_order_search_limit tables are ordered by least estimated cost
+index_selectivity_threshold = 0.2
+join_order_search_limit = 10
+
+# Scans evaluate comparisons of int and date columns with NumPy on batches of this many encoded rows
+# and decode only the rows passing them. 0 evaluates every row in Python
+scan_batch_size = 16384
+
+# Statements taking slow_query_threshold seconds or more are appended to slow_query_log_path as JSON lines,
+# None keeps no log. Totals per statement kind are written to metrics_dump_path, when it is set,
+# every metrics_dump_interval seconds and when the database is closed
+slow_query_threshold = 1.0
+slow_query_log_path = 'DB/slow_query.log'
+metrics_dump_path = None
+metrics_dump_interval = 60
+
+# The REPL formats rows and writes them to its output in chunks of this many rows
+output_chunk_rows = 4096
+
+# Parser of grammar.lark, loaded by the first connection
+sql_parser = None
+
+# Database shared by the connections of this process, opened by the first one and closed by the last one
+database, database_users = None, 0
+
+# run.py --serve accepts clients on this address, or on a Unix socket given by --socket.
+# Statements of each client run in a thread of its own, rows are sent in batches of server_fetch_size
+server_host = '127.0.0.1'
+server_port = 7878
+server_fetch_size = 1000
+
+
+# Errors reported to the client follow the Python database API, message is what the REPL prints
+class Error(Exception):
+    pass
+
+
+# Connection or cursor is used in a wrong way
+class InterfaceError(Error):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+# Statement is not valid: syntax error or reference to non existing table, column or statement
+class ProgrammingError(DatabaseError):
+    pass
+
+
+# Value does not match the type of its column or comparison
+class DataError(DatabaseError):
+    pass
+
+
+# Primary key, foreign key or not null constraint is violated
+class IntegrityError(DatabaseError):
+    pass
+
+
+# Statement can not run in the current state: transaction state or missing input file
+class OperationalError(DatabaseError):
+    pass
+
+
+def typed_error(error):
+    # Return Error reported for an exception of the storage, the file system or the CSV reader, None for other exceptions
+    if isinstance(error, db.DBLockDeadlockError):
+        return OperationalError("Statement has failed: rows are changed by a concurrent transaction") # SerializationError
+    if isinstance(error, db.DBError):
+        return OperationalError(f"Statement has failed: {error.args[-1] if error.args else 'storage error'}") # StorageError
+    if isinstance(error, OSError):
+        return OperationalError(f"Statement has failed: {error}") # FileAccessError
+    if isinstance(error, csv.Error):
+        return DataError(f"Load data has failed: {error}") # LoadFileFormatError
+    return None
+
 
 class MyTransformer(Transformer):
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+        self.catalog, self.pool = session.catalog, session.pool
+
+
     def command(self, items):
         # When query is exit; or EXIT;
         if hasattr(items[0], 'type'):
-            exit(0)
+            raise SystemExit(0)
         # When query is not exit; or EXIT;
         else:
             return items[0]
@@ -24,8 +190,7 @@ class MyTransformer(Transformer):
         table_schema_path = 'DB/'+table_name+'_schema.db'
 
         if os.path.exists(table_schema_path):
-            print(f"{prompt_msg}Create table has failed: table with the same name already exists") # TableExistenceError
-            return
+            raise ProgrammingError("Create table has failed: table with the same name already exists") # TableExistenceError
         
         metaDB = db.DB()
         metaDB.open(table_schema_path, dbtype=db.DB_HASH, flags=db.DB_CREATE)
@@ -41,16 +206,17 @@ class MyTransformer(Transformer):
             if column_type == "char":
                 char_len = column_definition.children[1].children[2]
                 if int(char_len) < 1:
-                    print(f"{prompt_msg}Char length should be over 0") # CharLengthError
                     os.remove(table_schema_path)
-                    return
+                    raise ProgrammingError("Char length should be over 0") # CharLengthError
+                if int(char_len) > max_char_length:
+                    os.remove(table_schema_path)
+                    raise ProgrammingError(f"Char length should be at most {max_char_length}") # CharLengthError
                 column_type += char_len
             try:
                 metaDB.put(column_name.encode(), column_type.encode(), flags=db.DB_NOOVERWRITE)
             except:
-                print(f"{prompt_msg}Create table has failed: column definition is duplicated") # DuplicateColumnDefError
                 os.remove(table_schema_path)
-                return
+                raise ProgrammingError("Create table has failed: column definition is duplicated") # DuplicateColumnDefError
             
             column_names.append(column_name)
 
@@ -70,16 +236,14 @@ class MyTransformer(Transformer):
         is_duplicate_primary_key = False
         for primary_key_constraint in primary_key_constraint_iter:
             if is_duplicate_primary_key:
-                print(f"{prompt_msg}Create table has failed: primary key definition is duplicated") # DuplicatePrimaryKeyDefError
                 os.remove(table_schema_path)
-                return
+                raise ProgrammingError("Create table has failed: primary key definition is duplicated") # DuplicatePrimaryKeyDefError
             primary_column_iter = primary_key_constraint.find_data("column_name")
             for primary_column in primary_column_iter:
                 primary_column_name = primary_column.children[0].lower()
                 if not metaDB.exists(primary_column_name.encode()):
-                    print(f"{prompt_msg}Create table has failed: {primary_column_name} does not exist in column definition") # NonExistingColumnDefError
                     os.remove(table_schema_path)
-                    return
+                    raise ProgrammingError(f"Create table has failed: {primary_column_name} does not exist in column definition") # NonExistingColumnDefError
                 primary_key.append(primary_column_name)
             is_duplicate_primary_key = True
         
@@ -88,10 +252,13 @@ class MyTransformer(Transformer):
 
         # Put 'reference_count' as key and 0 as value
         metaDB.put('reference_count'.encode(), '0'.encode())
+
+        # Put 'storage_format' as key and version of table file layout as value
+        metaDB.put('storage_format'.encode(), storage_format_version.encode())
         
         # Iterate foreign key constraints to find foreign key column names and their references
         referential_constraint_iter = items[3].find_data("referential_constraint")
-        foreign_keys, referenced_tables = [], []
+        foreign_keys, foreign_key_indexes, referenced_tables = [], [], []
         for referential_constraint in referential_constraint_iter:
             foreign_key, referenced_key = [], []
 
@@ -99,89 +266,66 @@ class MyTransformer(Transformer):
             for referencing_column in referencing_column_iter:
                 referencing_column_name = referencing_column.children[0].lower()
                 if not metaDB.exists(referencing_column_name.encode()):
-                    print(f"{prompt_msg}Create table has failed: {referencing_column_name} does not exist in column definition") # NonExistingColumnDefError
                     os.remove(table_schema_path)
-                    return
+                    raise ProgrammingError(f"Create table has failed: {referencing_column_name} does not exist in column definition") # NonExistingColumnDefError
                 foreign_key.append(referencing_column_name)
 
             referenced_table_name = referential_constraint.children[4].children[0].lower()
             if table_name == referenced_table_name:
-                print(f"{prompt_msg}Create table has failed: cannot reference itself")
                 os.remove(table_schema_path)
-                return
-            referenced_table_schema_path = 'DB/'+referenced_table_name+'_schema.db'
-            referenced_tables.append(referenced_table_schema_path)
+                raise ProgrammingError("Create table has failed: cannot reference itself")
+            referenced_tables.append(referenced_table_name)
 
             referenced_column_iter = referential_constraint.children[5].find_data("column_name")
             for referenced_column in referenced_column_iter:
                 referenced_column_name = referenced_column.children[0].lower()
                 referenced_key.append(referenced_column_name)
             
-            referencedDB = db.DB()
-            try:
-                referencedDB.open(referenced_table_schema_path, dbtype=db.DB_HASH)
-            except:
-                print(f"{prompt_msg}Create table has failed: foreign key references non existing table") # ReferenceTableExistenceError
+            referenced_schema = self.catalog.get(referenced_table_name)
+            if referenced_schema is None:
                 os.remove(table_schema_path)
-                return
+                raise ProgrammingError("Create table has failed: foreign key references non existing table") # ReferenceTableExistenceError
+            referenced_table_primary_key_list = list(referenced_schema.primary_key)
 
             # Iterate foreign key and referenced key to compare correctness
             for referencing_column_name, referenced_column_name in zip(foreign_key, referenced_key):
-                if not referencedDB.exists(referenced_column_name.encode()):
-                    print(f"{prompt_msg}Create table has failed: foreign key references non existing column") # ReferenceColumnExistenceError
+                if referenced_column_name not in referenced_schema.column_type:
                     os.remove(table_schema_path)
-                    referencedDB.close()
-                    return
-                
-                referenced_table_primary_key = referencedDB.get('primary_key'.encode())
-                referenced_table_primary_key_list = referenced_table_primary_key.decode().split('COLUMN')
+                    raise ProgrammingError("Create table has failed: foreign key references non existing column") # ReferenceColumnExistenceError
 
-                referenced_column_is_non_primary = False
-                if referenced_table_primary_key is None:
-                    referenced_column_is_non_primary = True
-                else:
-                    if referenced_column_name not in referenced_table_primary_key_list:
-                        referenced_column_is_non_primary = True
-                    else:
-                        referenced_table_primary_key_list.remove(referenced_column_name)
-                if referenced_column_is_non_primary:
-                    print(f"{prompt_msg}Create table has failed: foreign key references non primary key column") # ReferenceNonPrimaryKeyError
+                if referenced_column_name not in referenced_table_primary_key_list:
                     os.remove(table_schema_path)
-                    referencedDB.close()
-                    return
+                    raise ProgrammingError("Create table has failed: foreign key references non primary key column") # ReferenceNonPrimaryKeyError
+                referenced_table_primary_key_list.remove(referenced_column_name)
                 
                 referencing_column_type = metaDB.get(referencing_column_name.encode()).decode()
-                referenced_column_type = referencedDB.get(referenced_column_name.encode()).decode()
-                if referencing_column_type != referenced_column_type:
-                    print(f"{prompt_msg}Create table has failed: foreign key references wrong type") # ReferenceTypeError
+                if referencing_column_type != referenced_schema.column_type[referenced_column_name]:
                     os.remove(table_schema_path)
-                    referencedDB.close()
-                    return
+                    raise ProgrammingError("Create table has failed: foreign key references wrong type") # ReferenceTypeError
             
             # When foreign key references not all primary key
             if referenced_table_primary_key_list:
-                print(f"{prompt_msg}Create table has failed: foreign key references non primary key column") # ReferenceNonPrimaryKeyError
                 os.remove(table_schema_path)
-                referencedDB.close()
-                return
+                raise ProgrammingError("Create table has failed: foreign key references non primary key column") # ReferenceNonPrimaryKeyError
             
             #If this foreign key has no error
             foreign_keys.append('COLUMN'.join(foreign_key)+'REFERENCE'+referenced_table_name+'REFERENCE'+'COLUMN'.join(referenced_key))
-            referencedDB.close()
+
+            # Referencing columns are indexed so that deleting a referenced row probes the index.
+            # Index names can not contain digits, so 'fk1', 'fk2', ... never clash with them
+            foreign_key_indexes.append('fk'+str(len(foreign_keys))+'ON'+'COLUMN'.join(foreign_key))
             
         # If all foreign keys have no error
         metaDB.put('foreign_key'.encode(), 'FOREIGN'.join(foreign_keys).encode())
+        metaDB.put('indexes'.encode(), 'INDEX'.join(foreign_key_indexes).encode())
         if foreign_keys:
-            for referenced_table_schema_path in referenced_tables:
-                referencedDB = db.DB()
-                referencedDB.open(referenced_table_schema_path, dbtype=db.DB_HASH)
-                reference_count = str(int(referencedDB.get('reference_count'.encode()).decode()) + 1)
-                referencedDB.put('reference_count'.encode(), reference_count.encode())
-                referencedDB.close()
+            for referenced_table_name in referenced_tables:
+                reference_count = self.catalog.get(referenced_table_name).reference_count + 1
+                self.catalog.update(referenced_table_name, 'reference_count', str(reference_count))
                 
         # Create table success
-        print(f"{prompt_msg}\'{table_name}\' table is created")
         metaDB.close()
+        return Result([f"'{table_name}' table is created"])
 
 
     def drop_table_query(self, items):
@@ -189,73 +333,126 @@ class MyTransformer(Transformer):
         table_path = 'DB/'+table_name+'.db'
         table_schema_path = 'DB/'+table_name+'_schema.db' 
 
-        if not os.path.exists(table_schema_path):
-            print(f"{prompt_msg}No such table") # NoSuchTable
-            return
-        
-        metaDB = db.DB()
-        metaDB.open(table_schema_path, dbtype=db.DB_HASH)
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
 
-        if metaDB.get('reference_count'.encode()).decode() != '0':
-            print(f"{prompt_msg}Drop table has failed: '{table_name}' is referenced by other table") # DropReferencedTableError
-            metaDB.close()
-            return
+        if schema.reference_count != 0:
+            raise IntegrityError(f"Drop table has failed: '{table_name}' is referenced by other table") # DropReferencedTableError
         
         # If drop has no errors, decrease reference_count by 1 in referenced table
-        if metaDB.get('foreign_key'.encode()).decode():
-            foreign_keys = metaDB.get('foreign_key'.encode()).decode().split('FOREIGN')
-            for foreign_key in foreign_keys:
-                referenced_table_name = foreign_key.split('REFERENCE')[1]
-                referenced_table_schema_path = 'DB/'+referenced_table_name+'_schema.db'
-                referencedDB = db.DB()
-                referencedDB.open(referenced_table_schema_path, dbtype=db.DB_HASH)
-                reference_count = str(int(referencedDB.get('reference_count'.encode()).decode()) - 1)
-                referencedDB.put('reference_count'.encode(), reference_count.encode())
+        for _, referenced_table_name, _ in schema.foreign_keys:
+            reference_count = self.catalog.get(referenced_table_name).reference_count - 1
+            self.catalog.update(referenced_table_name, 'reference_count', str(reference_count))
                 
         # Drop success
+        self.catalog.invalidate(table_name)
         os.remove(table_schema_path)
-        if os.path.exists(table_path):
-            os.remove(table_path)
-        print(f"{prompt_msg}'{table_name}' table is dropped")
+        self.session.database.remove_file(table_path)
+        for index_name, _ in schema.indexes:
+            self.session.database.remove_file(secondary_index_path(table_name, index_name))
+        return Result([f"'{table_name}' table is dropped"])
         
     
+    def create_index_query(self, items):
+        index_name = items[2].children[0].lower()
+        table_name = items[4].children[0].lower()
+
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
+        column_names = schema.column_names
+
+        if index_name in [name for name, _ in schema.indexes]:
+            raise ProgrammingError("Create index has failed: index with the same name already exists") # IndexExistenceError
+
+        index_columns = []
+        for index_column in items[5].find_data('column_name'):
+            index_column_name = index_column.children[0].lower()
+            if index_column_name not in column_names:
+                raise ProgrammingError(f"Create index has failed: {index_column_name} does not exist in column definition") # NonExistingColumnDefError
+            index_columns.append(index_column_name)
+
+        # Build index from existing rows
+        index_indices = [column_names.index(column_name) for column_name in index_columns]
+        txn = self.session.txn
+        indexDB = self.pool.index(table_name, index_name)
+        for key, value in scan_table_items(self.pool.table(table_name), txn, schema.codec.decode):
+            put_secondary_index(indexDB, txn, index_indices, schema.column_types, value, key)
+
+        # Put 'indexes' as key and index definitions separated by 'INDEX' as value into db
+        index_list = [name+'ON'+'COLUMN'.join(column_names[idx] for idx in indices) for name, indices in schema.indexes]
+        index_list.append(index_name+'ON'+'COLUMN'.join(index_columns))
+        self.catalog.update(table_name, 'indexes', 'INDEX'.join(index_list))
+        return Result([f"'{index_name}' index is created"])
+
+
+    def drop_index_query(self, items):
+        index_name = items[2].children[0].lower()
+        table_name = items[4].children[0].lower()
+
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
+
+        if index_name not in [name for name, _ in schema.indexes]:
+            raise ProgrammingError("No such index") # NoSuchIndex
+
+        index_list = [name+'ON'+'COLUMN'.join(schema.column_names[idx] for idx in indices) for name, indices in schema.indexes if name != index_name]
+        self.catalog.update(table_name, 'indexes', 'INDEX'.join(index_list))
+        self.session.database.remove_file(secondary_index_path(table_name, index_name))
+        return Result([f"'{index_name}' index is dropped"])
+
+
     def explain_query(self, items):
-        self.desc_query(items)
+        # EXPLAIN table is DESC. EXPLAIN of select, delete or update shows its plan tree, and EXPLAIN ANALYZE
+        # runs the statement and adds what each operator did
+        if len(items) == 2:
+            return self.desc_query(items)
+        explained = items[2].children[0]
+        planners = {'select_query': self.plan_select, 'delete_query': self.plan_delete, 'update_tables_query': self.plan_update}
+        plan_node = self.statement_plan(planners[explained.data], explained.children)[-1]
+        if not items[1]:
+            return Result(columns=["plan"], rows=((line,) for line in plan_node.lines(False)), printer=print_plan)
+
+        # Nodes of the plan of this statement count from now on, pages are taken from buffer pool statistics
+        nodes = list(plan_node.nodes())
+        for node in nodes:
+            node.instrumented = True
+            node.reset()
+        pages_before, start = file_page_requests(self.session.dbEnv), time.perf_counter()
+        result = getattr(self, explained.data)(explained.children)
+        for _ in result.rows or ():
+            pass
+        elapsed = time.perf_counter() - start
+        pages_after = file_page_requests(self.session.dbEnv)
+        if result.rows is None:
+            plan_node.rows, plan_node.seconds, plan_node.ran = result.rowcount, elapsed, True
+        for node in nodes:
+            node.pages = sum(pages_after.get(file, 0) - pages_before.get(file, 0) for file in {file for child in node.nodes() for file in child.files})
+        lines = list(plan_node.lines(True)) + [f"Execution time: {elapsed * 1000:.3f} ms"]
+        return Result(result.messages, result.rowcount, ["plan"], ((line,) for line in lines), print_plan)
     
 
     def describe_query(self, items):
-        self.desc_query(items)
+        return self.desc_query(items)
 
 
     def desc_query(self, items):
         table_name = items[1].children[0].lower()
-        table_schema_path = 'DB/'+table_name+'_schema.db' 
 
-        if not os.path.exists(table_schema_path):
-            print(f"{prompt_msg}No such table") # NoSuchTable
-            return
-        
-        metaDB = db.DB()
-        metaDB.open(table_schema_path, dbtype=db.DB_HASH)
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
 
         # Get table information
-        columns, primary, foreign, not_null = [], [], [], []
-
-        column_names = metaDB.get('column_names'.encode()).decode().split('COLUMN')
-        for column_name in column_names:
-            columns.append((column_name, metaDB.get(column_name.encode()).decode()))
-        primary = metaDB.get('primary_key'.encode()).decode().split('COLUMN')
-        foreign_keys = metaDB.get('foreign_key'.encode()).decode().split('FOREIGN')
-        for foreign_key in foreign_keys:
-            foreign.extend(foreign_key.split('REFERENCE')[0].split('COLUMN'))
-        not_null = metaDB.get('not_null'.encode()).decode().split('COLUMN')
-        metaDB.close()
+        columns = list(zip(schema.column_names, schema.column_types))
+        primary, not_null = schema.primary_key, schema.not_null
+        foreign = [column_name for foreign_key, _, _ in schema.foreign_keys for column_name in foreign_key]
 
-        # Print table information
-        print("-----------------------------------------------------------------")
-        print(f"table_name [{table_name}]")
+        # Table information is a row of each column
         headers = ["column_name", "type", "null", "key"]
-        print("{:20} {:15} {:10} {:10}".format(*headers))
+        rows = []
         for column_name, column_type in columns:
             null, key = 'Y', ''
             if 'char' in column_type:
@@ -267,46 +464,72 @@ class MyTransformer(Transformer):
                 null = 'N'
             if column_name in foreign:
                 key = 'FOR'
-            row = [column_name, column_type, null, key]
-            print("{:20} {:15} {:10} {:10}".format(*row))
-        print("-----------------------------------------------------------------")
+            rows.append((column_name, column_type, null, key))
+        return Result(columns=headers, rows=iter(rows), printer=lambda rows, headers, file: print_description(table_name, rows, headers, file))
 
 
     def show_tables_query(self, items):
-        print("-----------------------------------------------------------------")
+        table_names = []
         files = glob('DB/*_schema.db')
         for file in files:
             name = os.path.splitext(file)[0]
             table_name = name[3:-7]
-            print(table_name)
-        print("-----------------------------------------------------------------")
+            table_names.append((table_name,))
+        return Result(columns=["table_name"], rows=iter(table_names), printer=print_table_names)
+
+
+    def show_stats_query(self, items):
+        # Totals of the statements run since the database was opened, times in milliseconds
+        rows = []
+        for kind, total in self.session.database.metrics.report():
+            count = total['count']
+            rows.append((kind.removesuffix('_query'), count, total['errors'], total['slow'],
+                         round(total['seconds'] * 1000 / count, 3) if count else 0.0, round(total['max_seconds'] * 1000, 3),
+                         round(total['parse_seconds'] * 1000, 3), round(total['plan_seconds'] * 1000, 3), round(total['execute_seconds'] * 1000, 3),
+                         total['rows_scanned'], total['rows_returned'], *(total[label] for label in storage_counter_names.values())))
+        columns = ["statement", "count", "errors", "slow", "mean_ms", "max_ms", "parse_ms", "plan_ms", "execute_ms",
+                   "rows_scanned", "rows_returned", *storage_counter_names.values()]
+        return Result(columns=columns, rows=iter(rows), printer=print_stats)
 
  
+    def statement_plan(self, plan_statement, items):
+        # Plan is built on first execution of the statement and reused until the catalog changes
+        statement, stats = self.session.statement, self.session.stats
+        if statement.plan is None or statement.catalog_version != self.catalog.version:
+            start = time.perf_counter()
+            statement.plan, statement.catalog_version = plan_statement(items), self.catalog.version
+            if stats:
+                stats.plan_seconds += time.perf_counter() - start
+        if stats and isinstance(statement.plan[-1], PlanNode):
+            stats.watch(statement.plan[-1])
+        return statement.plan
+
+
     def select_query(self, items):
+        # Rows are pulled from the pipeline as the client reads them
+        headers, plan_rows, _ = self.statement_plan(self.plan_select, items)
+        return Result(columns=headers, rows=plan_rows())
+
+
+    def plan_select(self, items):
+        # Return (headers, callable building the row pipeline, plan node)
         referred_table_iter = items[2].find_data('referred_table')
         column_names, column_types, table_column_names = [], [], []
 
         # Get referred table names
-        table_names = []
+        table_names, schemas = [], []
         for referred_table in referred_table_iter:
             table_name = referred_table.children[0].children[0].lower()
             table_names.append(table_name)
 
         for table_name in table_names:
-            table_schema_path = 'DB/'+table_name+'_schema.db' 
-            if not os.path.exists(table_schema_path):
-                print(f"{prompt_msg}Selection has failed: {table_name} does not exist") # SelectTableExistenceError
-                return
-            else:
-                metaDB = db.DB()
-                metaDB.open(table_schema_path)
-                column_names_tmp = metaDB.get('column_names'.encode()).decode().split('COLUMN')
-                for column_name in column_names_tmp:
-                    column_names.append(column_name)
-                    column_type = metaDB.get(column_name.encode()).decode()
-                    column_types.append(column_type)
-                    table_column_names.append((table_name, column_name))
-                metaDB.close()
+            schema = self.catalog.get(table_name)
+            if schema is None:
+                raise ProgrammingError(f"Selection has failed: {table_name} does not exist") # SelectTableExistenceError
+            schemas.append(schema)
+            column_names.extend(schema.column_names)
+            column_types.extend(schema.column_types)
+            table_column_names.extend((table_name, column_name) for column_name in schema.column_names)
 
         # Get selected columns and selected indices
         selected_column_iter = items[1].find_data('selected_column')
@@ -319,11 +542,9 @@ class MyTransformer(Transformer):
                 table = ''
             column_name = selected_column.children[1].children[0].lower()
             if table and table not in table_names:
-                print(f"{prompt_msg}Selection has failed: {table} does not exist") # SelectTableExistenceError
-                return
+                raise ProgrammingError(f"Selection has failed: {table} does not exist") # SelectTableExistenceError
             if column_name not in column_names or (not table and column_names.count(column_name) > 1):
-                print(f"{prompt_msg}Selection has failed: fail to resolve {column_name}") # SelectColumnResolveError
-                return
+                raise ProgrammingError(f"Selection has failed: fail to resolve {column_name}") # SelectColumnResolveError
             if table:
                 selected_columns.append((table + '.' + column_name))
                 selected_indices.append(table_column_names.index((table, column_name)))
@@ -331,491 +552,3084 @@ class MyTransformer(Transformer):
                 selected_columns.append(column_name)
                 selected_indices.append(column_names.index(column_name))
         
-        # Make temporary cartesian table DB
-        tmpDB = db.DB()
-        tmp_path = 'DB/tmp.db'
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-        tmpDB.open(tmp_path, dbtype=db.DB_HASH, flags=db.DB_CREATE)
-
-        for i, table_name in enumerate(table_names):
-            cartesian_values = []
-            tableDB = db.DB()
-            table_path = 'DB/'+table_name+'.db'
-            tableDB.open(table_path, dbtype=db.DB_HASH)
-            cursor_tmp = tmpDB.cursor()
-
-            while x := cursor_tmp.next():
-                key_tmp, _ = x
-                cursor_table = tableDB.cursor()
-                while y := cursor_table.next():
-                    key_table, _ = y
-                    tmp_values = key_tmp.decode().split('COLUMN')
-                    table_values = key_table.decode().split('COLUMN')
-                    tmp_values.extend(table_values)
-                    cartesian_values.append(tmp_values)
-                tmpDB.delete(key_tmp)
-
-            for cartesian_value in cartesian_values:
-                tmpDB.put('COLUMN'.join(cartesian_value).encode(), ''.encode())
-
-            # When first table, just copy it to tmp
-            if i == 0:
-                cursor_table = tableDB.cursor()
-                while x := cursor_table.next():
-                    key_table, _ = x
-                    tmpDB.put(key_table, ''.encode())
-
-            tableDB.close()
+        # Plan pull-based pipeline: scan -> join -> filter -> project
+        where_expr = items[2].children[1].children[1] if items[2].children[1] else None
 
+        # Only columns which are selected or referenced in where clause are decoded
+        used_columns = None
         if selected_columns:
-            line = '-'  * 20 * len(selected_columns)
-            first_time = True
-            cursor_tmp = tmpDB.cursor()
-            while x := cursor_tmp.next():
-                key_tmp, _ = x
-                value = key_tmp.decode().split('COLUMN')
-                selected_value = []
-                for idx in selected_indices:
-                    selected_value.append(value[idx])
-
-                # When where clause exists
-                if items[2].children[1]:
-                    try:
-                        if evaluate_bool_expr(items[2].children[1].children[1], value, column_names, column_types, table_column_names):
-                            if first_time:
-                                print(line)
-                                print(("{:<20} " * len(selected_columns)).format(*selected_columns))
-                                print(line)
-                                first_time = False
-                            print(("{:<20} " * len(selected_value)).format(*selected_value))
-                        else:
-                            continue
-                    except:
-                        return
-                # When where clause not exists
-                else: 
-                    if first_time:
-                        print(line)
-                        print(("{:<20} " * len(selected_columns)).format(*selected_columns))
-                        print(line)
-                        first_time = False
-                    print(("{:<20} " * len(selected_value)).format(*selected_value))
-
-            print(line)
-        else: # When select all
-            line = '-'  * 20 * len(column_names)
-            first_time = True
-            cursor_tmp = tmpDB.cursor()
-            while x := cursor_tmp.next():
-                key_tmp, _ = x
-                value = key_tmp.decode().split('COLUMN')
-
-                # When where clause exists
-                if items[2].children[1]:
-                    try:
-                        if evaluate_bool_expr(items[2].children[1].children[1], value, column_names, column_types, table_column_names):
-                            if first_time:
-                                print(line)
-                                print(("{:<20} " * len(column_names)).format(*column_names))
-                                print(line)
-                                first_time = False
-                            print(("{:<20} " * len(value)).format(*value))
-                        else:
-                            continue
-                    except:
-                        return
-                # When where clause not exists
-                else: 
-                    if first_time:
-                        print(line)
-                        print(("{:<20} " * len(column_names)).format(*column_names))
-                        print(line)
-                        first_time = False
-                    print(("{:<20} " * len(value)).format(*value))
-
-            print(line)
+            used_columns = set(selected_indices)
+            if where_expr:
+                used_columns.update(find_where_columns(where_expr, column_names, table_column_names))
+        join_rows, join_node = plan_join_rows(self.session, schemas, column_names, column_types, table_column_names, where_expr, used_columns)
+        headers, make_rows, node = column_names, join_rows, join_node
+        if selected_columns:
+            project_node = PlanNode("Project", ', '.join(selected_columns), join_node.estimate, [join_node])
+            headers, make_rows, node = selected_columns, lambda: project_node.output(project_rows(join_rows(), selected_indices)), project_node
 
-        # Select Success
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        # Rows after the last one are never pulled, so scans and joins below stop early
+        if items[3]:
+            limit = limit_operand(items[3].children[1])
+            offset = limit_operand(items[3].children[3]) if items[3].children[3] else 0
+            estimate = min(node.estimate, limit) if node.estimate is not None and isinstance(limit, int) else None
+            limit_node = PlanNode("Limit", f"{limit} offset {offset}" if offset else str(limit), estimate, [node])
+            limited_rows = make_rows
+            make_rows, node = lambda: limit_node.output(limit_rows(limited_rows(), bound_value(limit), bound_value(offset))), limit_node
+        return headers, make_rows, node
 
         
     def insert_query(self, items):
+        schema, convert_row, rows = self.statement_plan(self.plan_insert, items)
+
+        # All rows are converted before the first one is written
+        if self.session.statement.parameters:
+            rows = [bind_inserted(row) for row in rows]
+        insert_count = insert_rows(self.session, schema, [(convert_row(row) for row in rows)])
+
+        # Insert success
+        if insert_count == 1:
+            return Result(["The row is inserted"], insert_count)
+        return Result([f"{insert_count} rows are inserted"], insert_count)
+
+
+    def plan_insert(self, items):
+        # Return (schema, row converter, inserted (type, value) or parameter of each row)
         table_name = items[2].children[0].lower()
-        table_path = 'DB/'+table_name+'.db' 
-        table_schema_path = 'DB/'+table_name+'_schema.db' 
 
-        if not os.path.exists(table_schema_path):
-            print(f"{prompt_msg}No such table") # NoSuchTable
-            return
-        
-        metaDB = db.DB()
-        metaDB.open(table_schema_path, dbtype=db.DB_HASH)
-        
-        column_names = metaDB.get('column_names'.encode()).decode().split('COLUMN')
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
 
         # Get inserted column names if insert has
-        has_column_names = False
-        insert_column_names = []
+        insert_column_names = None
         if items[3]:
-            has_column_names = True
-            insert_column_iter = items[3].find_data('column_name')
-            for insert_column in insert_column_iter:
-                insert_column_names.append(insert_column.children[0])
-
-        # Get inserted types and values
-        inserted_types, inserted_values = [], []
-        insert_value_iter = items[5].find_data('insert_value')
-        for insert_value in insert_value_iter:
-            type = insert_value.children[0].type.lower()
-            value = insert_value.children[0]
-            if value[0] == "'" or value[0] == '"':
-                value = value[1:-1]
-            inserted_types.append(type)
-            inserted_values.append(value)
-
-        # Get primary key and not null constraint
-        primary_key = metaDB.get('primary_key'.encode()).decode()
-        if primary_key:
-            primary_key = primary_key.split('COLUMN')
+            insert_column_names = [insert_column.children[0].lower() for insert_column in items[3].find_data('column_name')]
+        convert_row = insert_row_converter(schema, insert_column_names)
+
+        # Get inserted (type, value) of each row, parameter is bound on each execution
+        rows = []
+        for insert_value_list in items[5:]:
+            inserted = []
+            for insert_value in insert_value_list.find_data('insert_value'):
+                token = insert_value.children[0]
+                if token.type == 'PARAM':
+                    inserted.append(token.value)
+                    continue
+                type = token.type.lower()
+                value = token
+                if value[0] == "'" or value[0] == '"':
+                    value = value[1:-1]
+                inserted.append((type, value))
+            rows.append(inserted)
+        return schema, convert_row, rows
+
+
+    def load_data_query(self, items):
+        file_path = items[2][1:-1]
+        table_name = items[4].children[0].lower()
+
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
+
+        insert_column_names = None
+        if items[5]:
+            insert_column_names = [insert_column.children[0].lower() for insert_column in items[5].find_data('column_name')]
+        convert_row = insert_row_converter(schema, insert_column_names)
+
+        if not os.path.isfile(file_path):
+            raise OperationalError(f"Load data has failed: '{file_path}' does not exist") # LoadFileExistenceError
+
+        # Each CSV record is a row, empty field is null
+        with open(file_path, newline='') as file:
+            records = (record for record in csv.reader(file) if record)
+            rows = (convert_row([('null', None) if text == '' else (None, text) for text in record]) for record in records)
+            try:
+                insert_count = insert_rows(self.session, schema, batched(rows, load_batch_size))
+            except UnicodeDecodeError:
+                line_number = undecodable_line(file_path, file.encoding)
+                raise DataError(f"Load data has failed: line {line_number} of '{file_path}' is not {file.encoding} text") # LoadFileDecodeError
+        return Result([f"{insert_count} rows are inserted"], insert_count)
+
+
+    def delete_query(self, items):
+        schema, predicate, access_path, node = self.statement_plan(self.plan_delete, items)
+        table_name = schema.table_name
+        scan = node.children[0]
+
+        # Rows are deleted in a child transaction, so that nothing is deleted when the statement fails
+        self.session.begin_statement()
+        txn = self.session.txn
+        try:
+            mainDB = self.pool.table(table_name)
+            column_types, codec, indexes = schema.column_types, schema.codec, schema.indexes
+
+            delete_count, referenced_count = 0, 0
+            # When where clause exists or rows may be referenced by other tables
+            if predicate or schema.reference_count:
+                predicate = predicate or (lambda value: True)
+
+                # Rows found through index are collected first, since the index is modified below
+                conjuncts = split_conjuncts(items[3].children[1]) if items[3] else []
+                batch_filter, other_conjuncts = compile_batch_filter(conjuncts, schema)
+                scan.note = None
+                if access_path:
+                    row_items = list(scan.output(scan.read(access_path(), access_path.access[1])))
+                elif parallel_scan_allowed(self.session, table_name):
+                    # Scan workers return only rows passing the where clause
+                    scan.note = f"{scan_parallelism} workers"
+                    row_items = scan.output(parallel_scan(self.session, schema, None, conjuncts, True))
+                    predicate = lambda value: True
+                elif batch_filter:
+                    scan.note = "batch filter"
+                    row_items = scan.output(batch_filter_rows(scan.read(table_items(mainDB, txn)), batch_filter, codec.decode, None, True))
+                    predicate = compile_conjuncts(other_conjuncts, schema) or (lambda value: True)
+                else:
+                    row_items = scan.output((key, codec.decode(value)) for key, value in scan.read(table_items(mainDB, txn)))
+
+                # Rows referenced by other tables are kept, found by probing referencing tables for the whole batch
+                if schema.reference_count:
+                    row_items = [(key, value) for key, value in row_items if predicate(value)]
+                    referenced = find_referenced_rows(self.session, schema, [value for _, value in row_items])
+                    referenced_count = len(referenced)
+                    row_items = [row_item for i, row_item in enumerate(row_items) if i not in referenced]
+                indexDBs = [(self.pool.index(table_name, index_name), index_indices) for index_name, index_indices in indexes]
+                for key, value in row_items:
+
+                    # Evaluate and delete record if result is true
+                    if predicate(value):
+                        mainDB.delete(key, txn=txn)
+                        for indexDB, index_indices in indexDBs:
+                            delete_secondary_index(indexDB, txn, index_indices, column_types, value, key)
+                        delete_count += 1
+            else: # When where clause not exists
+                delete_count = mainDB.truncate(txn=txn)
+                for index_name, _ in indexes:
+                    self.pool.index(table_name, index_name).truncate(txn=txn)
+        except BaseException:
+            self.session.end_statement(False)
+            raise
+        self.session.end_statement(True)
+
+        # Delete Success        
+        messages = [f"{delete_count} row(s) are deleted"]
+        if referenced_count:
+            messages.append(f"{referenced_count} row(s) are not deleted due to referential integrity") # DeleteReferentialIntegrityPassed
+        return Result(messages, delete_count)
+
+
+    def plan_delete(self, items):
+        # Return (schema, predicate or None, access path or None, plan node)
+        table_name = items[2].children[0].lower()
+
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
+        predicate, access_path, scan = self.plan_where(schema, items[3])
+        return schema, predicate, access_path, PlanNode(f"Delete on {table_name}", None, scan.estimate, [scan], table_files(schema))
+
+
+    def plan_where(self, schema, where_clause):
+        # Return compiled predicate and access path through primary key or index when where clause
+        # allows it, or None for both without where clause, and the plan node reading the rows
+        column_names, column_types = schema.column_names, schema.column_types
+        table_column_names = [(schema.table_name, column_name) for column_name in column_names]
+        if not where_clause:
+            return None, None, scan_node(schema, None, [], schema.statistics.row_count if schema.statistics else None)
+        conjuncts = split_conjuncts(where_clause.children[1])
+        predicate = compile_bool_expr(where_clause.children[1], column_names, column_types, table_column_names)
+        access_path = plan_access_path(self.session, schema.table_name, schema.primary_key_indices, schema.indexes, conjuncts, column_names, column_types, table_column_names, schema.codec.decode, schema.statistics)
+        estimate = None
+        if schema.statistics:
+            estimate = schema.statistics.row_count * estimate_selectivity(where_clause.children[1], schema.statistics, column_names, column_types, table_column_names)
+        return predicate, access_path, scan_node(schema, access_path, conjuncts, estimate)
+
+
+    def update_tables_query(self, items):
+        schema, assigned, predicate, access_path, node = self.statement_plan(self.plan_update, items)
+
+        # Parameters of assigned values are converted once per execution
+        assignments = {}
+        for idx, value in assigned.items():
+            if isinstance(value, Parameter):
+                value = convert_assigned_value(schema, schema.column_names[idx], *parameter_item(value.value))
+            assignments[idx] = value
+
+        update_count, referenced_count = update_rows(self.session, schema, predicate or (lambda value: True), access_path, assignments, node.children[0])
+
+        # Update success
+        messages = [f"{update_count} row(s) are updated"]
+        if referenced_count:
+            messages.append(f"{referenced_count} row(s) are not updated due to referential integrity") # UpdateReferentialIntegrityPassed
+        return Result(messages, update_count)
+
+
+    def plan_update(self, items):
+        # Return (schema, assigned value or parameter of each column index, predicate, access path, plan node)
+        table_name = items[1].children[0].lower()
+        where_clause = items[-1]
+
+        schema = self.catalog.get(table_name)
+        if schema is None:
+            raise ProgrammingError("No such table") # NoSuchTable
+
+        # Convert assigned literals into typed values, checking column existence, types and not null constraint
+        assigned = {}
+        for update_column in items[3:-1]:
+            column_name = update_column.children[0].children[0].lower()
+            token = update_column.children[1].children[0]
+            if column_name not in schema.column_type:
+                raise ProgrammingError(f"Update has failed: '{column_name}' does not exist") # UpdateColumnExistenceError
+            if token.type == 'PARAM':
+                assigned[schema.column_names.index(column_name)] = token.value
+                continue
+            assigned_type = token.type.lower()
+            assigned[schema.column_names.index(column_name)] = convert_assigned_value(schema, column_name, assigned_type, token[1:-1] if assigned_type == 'str' else token)
+
+        # Find target rows through compiled predicate and primary key or index when where clause allows it
+        predicate, access_path, scan = self.plan_where(schema, where_clause)
+        node = PlanNode(f"Update on {table_name}", ', '.join(schema.column_names[idx] for idx in assigned), scan.estimate, [scan], table_files(schema))
+        return schema, assigned, predicate, access_path, node
+
+
+    def begin_query(self, items):
+        if self.session.txn:
+            raise OperationalError("Begin has failed: transaction is already in progress") # TransactionInProgressError
+        self.session.begin_transaction()
+        return Result(["Transaction has begun"])
+
+
+    def commit_query(self, items):
+        if not self.session.txn:
+            raise OperationalError("Commit has failed: no transaction in progress") # NoTransactionError
+        self.session.commit()
+        return Result(["Transaction is committed"])
+
+
+    def rollback_query(self, items):
+        if not self.session.txn:
+            raise OperationalError("Rollback has failed: no transaction in progress") # NoTransactionError
+        self.session.rollback()
+        return Result(["Transaction is rolled back"])
+
+
+    def prepare_query(self, items):
+        name = items[1].children[0].lower()
+
+        # Prepared statement owns a copy of the query, so that its placeholders become its own parameters
+        statement = Statement(copy.deepcopy(items[3].children[0]))
+        self.plan_statement(statement)
+        self.session.prepared[name] = statement
+        return Result([f"'{name}' statement is prepared"])
+
+
+    def execute_query(self, items):
+        name = items[1].children[0].lower()
+        statement = self.session.prepared.get(name)
+        if statement is None:
+            raise ProgrammingError(f"Execute has failed: '{name}' is not prepared") # ExecuteStatementExistenceError
+
+        # Convert literals into values bound to parameters in order
+        values = []
+        for execute_value in items[2].find_data('execute_value') if items[2] else []:
+            token = execute_value.children[0]
+            if token.type == 'INT':
+                values.append(int(token))
+            elif token.type == 'STR':
+                values.append(token[1:-1])
+            elif token.type == 'NULL':
+                values.append(None)
+            else:
+                try:
+                    values.append(date.fromisoformat(token))
+                except ValueError:
+                    raise DataError("Execute has failed: Types are not matched") # ExecuteTypeMismatchError
+        return self.session.dispatch(statement, values)
+
+
+    def deallocate_query(self, items):
+        name = items[-1].children[0].lower()
+        if self.session.prepared.pop(name, None) is None:
+            raise ProgrammingError(f"Deallocate has failed: '{name}' is not prepared") # DeallocateStatementExistenceError
+        return Result([f"'{name}' statement is deallocated"])
+
+
+    def plan_statement(self, statement):
+        # Validate and plan statement given to PREPARE without running it
+        planners = {'select_query': self.plan_select, 'insert_query': self.plan_insert,
+                    'delete_query': self.plan_delete, 'update_tables_query': self.plan_update}
+        self.session.statement = statement
+        return self.statement_plan(planners[statement.kind], statement.query.children)
+
+
+    def analyze_query(self, items):
+        # Collect statistics of the table, or of every table, and keep them in the schema for the planner
+        if items[1]:
+            table_names = [items[1].children[0].lower()]
+            if self.catalog.get(table_names[0]) is None:
+                raise ProgrammingError("No such table") # NoSuchTable
         else:
-            primary_key = []
+            table_names = sorted(os.path.basename(path)[:-len('_schema.db')] for path in glob('DB/*_schema.db'))
 
-        not_null = metaDB.get('not_null'.encode()).decode()
-        if not_null:
-            not_null = not_null.split('COLUMN')
+        messages = []
+        for table_name in table_names:
+            schema = self.catalog.get(table_name)
+            rows = scan_table(self.pool.table(table_name), self.session.txn, schema.codec.decode)
+            self.catalog.update(table_name, 'statistics', json.dumps(collect_statistics(rows, schema.column_types)))
+            messages.append(f"'{table_name}' table is analyzed")
+        return Result(messages)
+
+
+class TableSchema:
+    # Typed view of a table schema stored in DB/<table>_schema.db
+    def __init__(self, table_name, metaDB):
+        self.table_name = table_name
+        self.column_names = split_schema_value(metaDB, 'column_names', 'COLUMN')
+        self.column_types = [metaDB.get(column_name.encode()).decode() for column_name in self.column_names]
+        self.column_type = dict(zip(self.column_names, self.column_types))
+        self.not_null = split_schema_value(metaDB, 'not_null', 'COLUMN')
+        self.primary_key = split_schema_value(metaDB, 'primary_key', 'COLUMN')
+        self.primary_key_indices = [self.column_names.index(column_name) for column_name in self.primary_key]
+
+        # List of (referencing columns, referenced table, referenced columns)
+        self.foreign_keys = []
+        for foreign_key in split_schema_value(metaDB, 'foreign_key', 'FOREIGN'):
+            referencing_columns, referenced_table_name, referenced_columns = foreign_key.split('REFERENCE')
+            self.foreign_keys.append((referencing_columns.split('COLUMN'), referenced_table_name, referenced_columns.split('COLUMN')))
+        self.reference_count = int(metaDB.get('reference_count'.encode()).decode())
+        self.indexes = read_indexes(metaDB, self.column_names)
+        self.codec = RowCodec(self.column_types)
+
+        # Put by ANALYZE, None when the table is not analyzed
+        statistics = metaDB.get('statistics'.encode())
+        self.statistics = TableStatistics(json.loads(statistics.decode())) if statistics else None
+
+
+class TableStatistics:
+    # Row count and, for each column, fraction of nulls, estimate of distinct values and bounds of
+    # equal-depth histogram buckets of the other values. Dates are kept as ordinals
+    def __init__(self, stored):
+        self.row_count = stored['row_count']
+        self.columns = stored['columns']
+
+    def distinct(self, idx):
+        return max(self.columns[idx]['distinct'], 1)
+
+    def null_fraction(self, idx):
+        return self.columns[idx]['nulls']
+
+    def selectivity(self, idx, op, value):
+        # Estimated fraction of rows whose column compares with value by op, value is None when it is
+        # a parameter bound on execution
+        column = self.columns[idx]
+        if not column['bounds']:
+            return 0.0
+        not_null, equal = 1 - column['nulls'], 1 / self.distinct(idx)
+        if op == '=':
+            return not_null * equal
+        if op == '!=':
+            return not_null * (1 - equal)
+        if value is None:
+            return not_null / 3
+        below = self.fraction_below(column['bounds'], value.toordinal() if isinstance(value, date) else value)
+        fraction = {'<': below, '<=': below + equal, '>': 1 - below - equal, '>=': 1 - below}[op]
+        return not_null * min(max(fraction, 0.0), 1.0)
+
+    @staticmethod
+    def fraction_below(bounds, value):
+        # Fraction of histogram values less than value, interpolated inside the bucket for numbers
+        i = bisect.bisect_left(bounds, value)
+        if i == 0:
+            return 0.0
+        if i == len(bounds):
+            return 1.0
+        low, high = bounds[i - 1], bounds[i]
+        within = (value - low) / (high - low) if isinstance(value, int) and high != low else 0.5
+        return (i - 1 + within) / (len(bounds) - 1)
+
+
+class Catalog:
+    # Schemas are loaded once per table and kept until the schema is changed
+    def __init__(self):
+        self.schemas = {}
+        self.references = {}
+        self.version = 0
+
+    def get(self, table_name):
+        # Return TableSchema of the table, or None when table does not exist
+        schema = self.schemas.get(table_name)
+        if schema is None:
+            table_schema_path = 'DB/'+table_name+'_schema.db'
+            if not os.path.exists(table_schema_path):
+                return None
+            metaDB = db.DB()
+            metaDB.open(table_schema_path, dbtype=db.DB_HASH)
+            schema = TableSchema(table_name, metaDB)
+            metaDB.close()
+            self.schemas[table_name] = schema
+        return schema
+
+    def update(self, table_name, key, value):
+        # Write one entry of the table schema, cached schema is reloaded on next get
+        metaDB = db.DB()
+        metaDB.open('DB/'+table_name+'_schema.db', dbtype=db.DB_HASH)
+        metaDB.put(key.encode(), value.encode())
+        metaDB.close()
+        self.invalidate(table_name)
+
+    def invalidate(self, table_name):
+        self.schemas.pop(table_name, None)
+        self.references.clear()
+        self.version += 1
+
+    def referencing(self, table_name):
+        # Return (referencing schema, referencing column indices, referenced column indices)
+        # of every foreign key which references the table
+        if table_name not in self.references:
+            schema, references = self.get(table_name), []
+            for table_schema_path in glob('DB/*_schema.db'):
+                child_schema = self.get(os.path.basename(table_schema_path)[:-len('_schema.db')])
+                for foreign_key, referenced_table_name, referenced_key in child_schema.foreign_keys:
+                    if referenced_table_name == table_name:
+                        references.append((child_schema,
+                                           [child_schema.column_names.index(column_name) for column_name in foreign_key],
+                                           [schema.column_names.index(column_name) for column_name in referenced_key]))
+            self.references[table_name] = references
+        return self.references[table_name]
+
+
+class HandlePool:
+    # Table and index files stay open across statements. Handles are closed in least recently
+    # used order by trim, which runs between transactions so that no scan or transaction loses its handle
+    def __init__(self, dbEnv, max_open_files):
+        self.dbEnv = dbEnv
+        self.max_open_files = max_open_files
+        self.handles = OrderedDict()
+
+    def table(self, table_name):
+        return self.get('DB/'+table_name+'.db', lambda: open_table(table_name, self.dbEnv))
+
+    def index(self, table_name, index_name):
+        return self.get(secondary_index_path(table_name, index_name), lambda: open_secondary_index(table_name, index_name, self.dbEnv))
+
+    def get(self, path, opener):
+        handle = self.handles.get(path)
+        if handle is None:
+            handle = self.handles[path] = opener()
         else:
-            not_null = []
-
-        # Compare column numbers
-        mismatch = False
-        table_columns_len = len(column_names)
-        inserted_values_len = len(inserted_values)
-        if table_columns_len != inserted_values_len:
-            mismatch = True
-        if has_column_names:
-            insert_columns_len = len(insert_column_names)
-            if insert_columns_len != table_columns_len or insert_columns_len != inserted_values_len:
-                mismatch = True
-        if mismatch:
-            print(f"{prompt_msg}Insertion has failed: Types are not matched") # InsertTypeMismatchError
+            self.handles.move_to_end(path)
+        return handle
+
+    def close(self, path):
+        handle = self.handles.pop(path, None)
+        if handle is not None:
+            handle.close()
+
+    def trim(self):
+        while len(self.handles) > self.max_open_files:
+            self.handles.popitem(last=False)[1].close()
+
+    def close_all(self):
+        while self.handles:
+            self.handles.popitem()[1].close()
+
+
+class SharedLock:
+    # Lock held by many threads in shared mode or by one thread in exclusive mode
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers, self.writer = 0, False
+
+    def acquire_shared(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writer)
+            self.readers += 1
+
+    def release_shared(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_exclusive(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writer and self.readers == 0)
+            self.writer = True
+
+    def release_exclusive(self):
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+
+class Database:
+    # State shared by the sessions of this process. Schema statements hold schema_lock exclusively and
+    # other statements share it. Transactions read a snapshot of committed rows, so reads never wait,
+    # and a transaction which writes holds write_lock until it ends, so writes run one at a time
+    def __init__(self, dbEnv):
+        self.dbEnv = dbEnv
+        self.catalog = Catalog()
+        self.schema_lock, self.write_lock = SharedLock(), threading.Lock()
+        self.sessions = weakref.WeakSet()
+        self.metrics = Metrics(dbEnv)
+        self.scan_executor, self.scan_executor_lock = None, threading.Lock()
+        # Commits are counted when they start and when they end, so that scan workers can tell
+        # whether their snapshot holds the same commits as the statement's
+        self.commits_started, self.commits_finished = multiprocessing.get_context('spawn').RawValue('q', 0), 0
+        # With 'group' policy a thread writes the log of commits no client has flushed
+        self.has_unflushed_commits, self.closing = False, threading.Event()
+        self.flusher = None
+        if sync_policy == 'group':
+            self.flusher = threading.Thread(target=self.flush_commits, daemon=True)
+            self.flusher.start()
+
+    def flush_commits(self):
+        while not self.closing.wait(group_commit_interval):
+            if self.has_unflushed_commits:
+                self.has_unflushed_commits = False
+                self.dbEnv.log_flush()
+
+    def scan_pool(self):
+        # Worker processes of parallel scans are started by the first one and join the environment
+        with self.scan_executor_lock:
+            if self.scan_executor is None:
+                self.scan_executor = ProcessPoolExecutor(scan_parallelism, mp_context=multiprocessing.get_context('spawn'),
+                                                         initializer=start_scan_worker, initargs=(self.commits_started,))
+            return self.scan_executor
+
+    def close(self):
+        if self.flusher:
+            self.closing.set()
+            self.flusher.join()
+        if self.scan_executor:
+            self.scan_executor.shutdown(cancel_futures=True)
+        if metrics_dump_path:
+            self.metrics.dump()
+        close_environment(self.dbEnv)
+
+    def remove_file(self, path):
+        # Close file of dropped table or index in every session and remove it, under exclusive schema_lock
+        for session in list(self.sessions):
+            session.discard_results()
+            session.pool.close(path)
+        if os.path.exists(path):
+            self.dbEnv.dbremove(os.path.relpath(path, 'DB'), flags=db.DB_AUTO_COMMIT)
+
+
+# Buffer pool counters of the environment charged to statements: pages found in and missing from the
+# cache, pages read from and written to the files
+storage_counter_names = {'cache_hit': 'cache_hits', 'cache_miss': 'cache_misses', 'page_in': 'pages_read', 'page_out': 'pages_written'}
+
+
+def storage_counters(dbEnv):
+    stat = dbEnv.memp_stat()[0]
+    return {label: stat.get(name, 0) for name, label in storage_counter_names.items()}
+
+
+class StatementStats:
+    # Measurements of one execution of a statement. Rows are pulled after the statement returns,
+    # so a statement returning rows is finished when its rows are exhausted or discarded
+    def __init__(self, metrics, kind, text, parse_seconds):
+        self.metrics, self.kind, self.text = metrics, kind, text
+        self.parse_seconds, self.plan_seconds, self.execute_seconds = parse_seconds, 0.0, 0.0
+        self.rows_scanned, self.rows_returned, self.failed = 0, 0, False
+        self.plan_node, self.scanned_before = None, 0
+        self.counters, self.finished = storage_counters(metrics.dbEnv), False
+
+    def watch(self, plan_node):
+        # Records read by the scans of the plan from now on are read by this statement
+        self.plan_node, self.scanned_before = plan_node, plan_node.total_scanned()
+
+    def finish(self):
+        if self.finished:
             return
+        self.finished = True
+        if self.plan_node:
+            self.rows_scanned = self.plan_node.total_scanned() - self.scanned_before
+        counters = storage_counters(self.metrics.dbEnv)
+        self.counters = {name: counters[name] - self.counters[name] for name in counters}
+        self.metrics.record(self)
+
+    def seconds(self):
+        return self.parse_seconds + self.plan_seconds + self.execute_seconds
+
+
+class Metrics:
+    # Totals of the statements run by the sessions of the database per statement kind, for SHOW STATS and
+    # the metrics dump. Buffer pool counters are shared by the environment, so a statement running
+    # along with others is also charged with the pages they request
+    totals = ['count', 'errors', 'slow', 'seconds', 'max_seconds', 'parse_seconds', 'plan_seconds', 'execute_seconds',
+              'rows_scanned', 'rows_returned'] + list(storage_counter_names.values())
+
+    def __init__(self, dbEnv):
+        self.dbEnv, self.lock = dbEnv, threading.Lock()
+        self.kinds, self.started, self.dumped = {}, time.time(), time.monotonic()
+
+    def record(self, stats):
+        seconds = stats.seconds()
+        is_slow = slow_query_threshold is not None and seconds >= slow_query_threshold
+        with self.lock:
+            total = self.kinds.setdefault(stats.kind, dict.fromkeys(self.totals, 0))
+            total['count'] += 1
+            total['errors'] += stats.failed
+            total['slow'] += is_slow
+            total['seconds'] += seconds
+            total['max_seconds'] = max(total['max_seconds'], seconds)
+            total['parse_seconds'] += stats.parse_seconds
+            total['plan_seconds'] += stats.plan_seconds
+            total['execute_seconds'] += stats.execute_seconds
+            total['rows_scanned'] += stats.rows_scanned
+            total['rows_returned'] += stats.rows_returned
+            for name, value in stats.counters.items():
+                total[name] += value
+            if is_slow and slow_query_log_path:
+                self.log_slow_query(stats, seconds)
+        if metrics_dump_path and time.monotonic() - self.dumped >= metrics_dump_interval:
+            self.dump()
+
+    def log_slow_query(self, stats, seconds):
+        entry = {'time': datetime.now().isoformat(timespec='milliseconds'), 'statement': stats.kind, 'text': stats.text,
+                 'failed': stats.failed, 'seconds': round(seconds, 6), 'parse_seconds': round(stats.parse_seconds, 6),
+                 'plan_seconds': round(stats.plan_seconds, 6), 'execute_seconds': round(stats.execute_seconds, 6),
+                 'rows_scanned': stats.rows_scanned, 'rows_returned': stats.rows_returned, **stats.counters}
+        with open(slow_query_log_path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+
+    def report(self):
+        # Return totals of each statement kind and of all statements, sorted by kind
+        with self.lock:
+            kinds = {kind: dict(total) for kind, total in self.kinds.items()}
+        all_kinds = dict.fromkeys(self.totals, 0)
+        for total in kinds.values():
+            for name, value in total.items():
+                all_kinds[name] = max(all_kinds[name], value) if name == 'max_seconds' else all_kinds[name] + value
+        return sorted(kinds.items()) + [('total', all_kinds)]
+
+    def dump(self):
+        # Written to a new file which replaces the old one, so that readers never see a partial dump
+        self.dumped = time.monotonic()
+        report = {'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                  'dumped': datetime.now().isoformat(timespec='seconds'),
+                  'statements': dict(self.report()), 'buffer_pool': storage_counters(self.dbEnv)}
+        with open(metrics_dump_path + '.tmp', 'w') as file:
+            json.dump(report, file, indent=2)
+        os.replace(metrics_dump_path + '.tmp', metrics_dump_path)
+
+
+def metered_rows(rows, stats):
+    # Count rows returned to the client and the time spent producing them, the statement is finished with its rows
+    try:
+        while True:
+            start = time.perf_counter()
+            row = next(rows, None)
+            stats.execute_seconds += time.perf_counter() - start
+            if row is None:
+                return
+            stats.rows_returned += 1
+            yield row
+    finally:
+        end_rows(rows, None)
+        stats.finish()
+
+
+class Session:
+    # State kept across statements of one client: open file handles and the transaction started by BEGIN.
+    # Schema catalog is shared with the other sessions of the database
+    def __init__(self, database):
+        self.database, self.dbEnv = database, database.dbEnv
+        self.catalog = database.catalog
+        self.pool = HandlePool(self.dbEnv, max_open_files)
+        self.txn, self.unflushed_commits = None, 0
+        self.is_writer, self.holds_schema_lock = False, False
+        self.snapshot_commits = None
+        self.statements, self.statement, self.stats = OrderedDict(), None, None
+        self.prepared = {}
+        self.results = weakref.WeakSet()
+        self.transformer = MyTransformer(self)
+        database.sessions.add(self)
+
+    def parse(self, text):
+        # Return Statement of the text from the cache of recently executed statements, parsing it on a miss
+        key = normalize_statement(text)
+        statement = self.statements.get(key)
+        if statement is None:
+            statement = self.statements[key] = Statement(parse_statement(key), key)
+            if len(self.statements) > statement_cache_size:
+                self.statements.popitem(last=False)
+        else:
+            self.statements.move_to_end(key)
+        return statement
+
+    def execute(self, text, values=None):
+        # Run one statement and return its Result, values are bound to '?' placeholders of the statement
+        start = time.perf_counter()
+        statement = self.parse(text)
+        if values is None and statement.parameters:
+            raise ProgrammingError("Statement with '?' has to be prepared") # UnpreparedParameterError
+        return self.run(statement, list(values or []), time.perf_counter() - start)
+
+    def prepare(self, text):
+        # Python interface of PREPARE. Return Statement to give to execute_prepared
+        statement = Statement(parse_statement(normalize_statement(text)), normalize_statement(text))
+        if statement.kind not in preparable_statements:
+            raise ProgrammingError("Prepare has failed: only select, insert, delete and update can be prepared") # PrepareStatementTypeError
+        self.transformer.plan_statement(statement)
+        return statement
+
+    def execute_prepared(self, statement, values):
+        # Python interface of EXECUTE, values are Python int, str, date or None
+        return self.run(statement, list(values))
+
+    def run(self, statement, values, parse_seconds=0.0):
+        # Schema files are not transactional, so schema statements commit the transaction in progress
+        # first and run while no statement of other sessions runs
+        kind = statement.kind
+        if kind == 'execute_query':
+            prepared = self.prepared.get(statement.query.children[1].children[0].lower())
+            kind = prepared.kind if prepared else kind
+        stats = StatementStats(self.database.metrics, kind, statement.text, parse_seconds) if kind else None
+        if kind == 'explain_query' and len(statement.query.children) == 3 and statement.query.children[1]:
+            # EXPLAIN ANALYZE runs the explained statement
+            kind = statement.query.children[2].children[0].data
+        if kind not in read_statements:
+            self.discard_results()
+        if kind in schema_statements:
+            if self.txn:
+                self.commit()
+            self.database.schema_lock.acquire_exclusive()
+        else:
+            self.database.schema_lock.acquire_shared()
+        self.stats, start = stats, time.perf_counter()
+        try:
+            result = self.run_locked(statement, values, kind)
+            if stats:
+                stats.execute_seconds += time.perf_counter() - start - stats.plan_seconds
+                if result.rows is None:
+                    stats.finish()
+            return result
+        except BaseException:
+            if stats:
+                stats.execute_seconds += time.perf_counter() - start - stats.plan_seconds
+                stats.failed = True
+                stats.finish()
+            raise
+        finally:
+            self.stats = None
+            if kind in schema_statements:
+                self.database.schema_lock.release_exclusive()
+            else:
+                self.database.schema_lock.release_shared()
+
+    def run_locked(self, statement, values, kind):
+        # Statement outside BEGIN ... COMMIT runs in a transaction of its own. Reading statements run in
+        # a snapshot which ends when the client has pulled their rows
+        if kind in write_statements or kind in schema_statements:
+            self.acquire_writer()
+        autocommit = self.txn is None and kind not in transaction_statements and kind not in read_statements
+        snapshot = self.txn is None and kind in read_statements
+        if autocommit:
+            self.begin()
+        elif snapshot:
+            self.txn = self.begin_snapshot()
+        try:
+            result = self.dispatch(statement, values)
+        except BaseException as error:
+            if autocommit and self.txn:
+                self.rollback()
+            elif snapshot:
+                self.txn.abort()
+                self.txn = None
+            if typed_error(error):
+                raise typed_error(error) from None
+            raise
+        if self.stats and result.rows is not None:
+            result.rows = metered_rows(result.rows, self.stats)
+        if autocommit:
+            self.commit()
+        elif snapshot:
+            result.hold(self.txn)
+            self.txn = None
+            if result.rows is None:
+                result.finish()
+        if result.rows is not None:
+            self.results.add(result)
+        elif self.txn is None and not self.results:
+            self.pool.trim()
+        return result
+
+    def dispatch(self, statement, values):
+        # Bind values to parameters, then call the method of the query rule with its children as
+        # transform would, without rebuilding the tree on every execution
+        if statement.query is None:
+            return self.transformer.command(statement.tree.children)
+        if len(values) != len(statement.parameters):
+            raise ProgrammingError(f"Execute has failed: {len(statement.parameters)} values are expected") # ExecuteParameterCountError
+
+        # Values bound for rows which are not read yet stay, this execution binds its values to a copy
+        if statement.parameters and statement.is_reading():
+            statement = statement.copy()
+        for parameter, value in zip(statement.parameters, values):
+            if not parameter.accepts(value):
+                raise DataError("Execute has failed: Types are not matched") # ExecuteTypeMismatchError
+            parameter.value = value
+        self.statement = statement
+        result = getattr(self.transformer, statement.kind)(statement.query.children)
+        if result.rows is not None:
+            statement.results.add(result)
+        return result
+
+    def begin(self):
+        self.txn = self.begin_snapshot()
+
+    def begin_snapshot(self):
+        # snapshot_commits is the number of commits the snapshot holds, or None when a commit was
+        # in progress as it began. Scan workers then cannot begin a snapshot holding the same commits
+        finished = self.database.commits_finished
+        txn = self.dbEnv.txn_begin(flags=db.DB_TXN_SNAPSHOT)
+        started = self.database.commits_started.value
+        self.snapshot_commits = started if started == finished else None
+        return txn
+
+    def begin_transaction(self):
+        # Transaction started by BEGIN spans statements, so schema statements of other sessions wait until it ends
+        self.database.schema_lock.acquire_shared()
+        self.holds_schema_lock = True
+        self.begin()
+
+    def acquire_writer(self):
+        if not self.is_writer:
+            self.database.write_lock.acquire()
+            self.is_writer = True
+
+    def end_transaction(self):
+        self.txn = None
+        if self.is_writer:
+            self.database.write_lock.release()
+            self.is_writer = False
+        if self.holds_schema_lock:
+            self.database.schema_lock.release_shared()
+            self.holds_schema_lock = False
+
+    def commit(self):
+        # Commit without waiting for the log to reach disk unless sync_policy is 'sync',
+        # with 'group' policy the log is flushed once for a group of commits or by the flusher of the database
+        self.discard_results()
+        if self.is_writer:
+            self.database.commits_started.value += 1
+        self.txn.commit(0 if sync_policy == 'sync' else db.DB_TXN_NOSYNC)
+        if self.is_writer:
+            self.database.commits_finished += 1
+        self.end_transaction()
+        if sync_policy == 'group':
+            self.unflushed_commits += 1
+            self.database.has_unflushed_commits = True
+            if self.unflushed_commits >= group_commit_size:
+                self.flush()
+
+    def rollback(self):
+        self.discard_results()
+        self.txn.abort()
+        self.end_transaction()
+
+    def discard_results(self):
+        # Rows which are not pulled yet hold cursors and page locks, so they are given up before
+        # the session writes or ends the transaction they are read in
+        for result in list(self.results):
+            result.discard()
+        self.results.clear()
+
+    def begin_statement(self):
+        # Writes of a statement go into a child transaction, so that a failed statement
+        # is undone without ending the transaction it runs in
+        self.statement_parent = self.txn
+        self.txn = self.dbEnv.txn_begin(parent=self.txn)
+
+    def end_statement(self, is_success):
+        if is_success:
+            self.txn.commit()
+        else:
+            self.txn.abort()
+        self.txn = self.statement_parent
+
+    def flush(self):
+        if self.unflushed_commits:
+            self.dbEnv.log_flush()
+            self.unflushed_commits = 0
+
+    def close(self):
+        # Transaction which is not committed by the client is rolled back
+        self.discard_results()
+        if self.txn:
+            self.rollback()
+        self.dbEnv.log_flush()
+        self.unflushed_commits = 0
+        self.pool.close_all()
+        self.database.sessions.discard(self)
+
+
+class Statement:
+    # Parsed statement with the plan built on its first execution, which is reused while
+    # catalog version stays the same. Placeholders '?' are replaced by parameters bound on execution.
+    # Compiled plan reads parameters as rows are pulled, so results are kept to tell whether rows of
+    # an earlier execution are still to be read with the values bound then
+    def __init__(self, tree, text=None):
+        self.tree, self.text = tree, text
+        self.query = statement_query(tree)
+        self.kind = self.query.data if self.query else None
+        self.parameters = replace_placeholders(self.query) if self.kind not in (None, 'prepare_query') else []
+        self.plan, self.catalog_version = None, None
+        self.results = weakref.WeakSet()
+
+    def is_reading(self):
+        return any(result.is_open() for result in self.results)
+
+    def copy(self):
+        # Statement with parameters of its own, planned again on its execution
+        statement = Statement(copy.deepcopy(self.tree), self.text)
+        for parameter, original in zip(statement.parameters, self.parameters):
+            parameter.literal_type = original.literal_type
+        return statement
+
+
+class Parameter:
+    # Placeholder of a prepared statement. literal_type is set when the plan compares it with a column
+    def __init__(self, index):
+        self.index, self.literal_type, self.value = index, None, None
+
+    def __str__(self):
+        return '?'
+
+    def accepts(self, value):
+        literal_type = value_literal_type(value)
+        if literal_type == 'int' and not -(1 << 63) <= value < (1 << 63):
+            return False
+        return value is None or (literal_type is not None and self.literal_type in (None, literal_type))
+
+
+def normalize_statement(text):
+    # Collapse whitespace outside of string literals, so that equivalent texts share a cache entry
+    return re.sub(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|\s+', lambda match: match.group(1) or ' ', text).strip()
+
+
+schema_statements = {'create_table_query', 'drop_table_query', 'create_index_query', 'drop_index_query', 'analyze_query'}
+transaction_statements = {'begin_query', 'commit_query', 'rollback_query'}
+write_statements = {'insert_query', 'load_data_query', 'delete_query', 'update_tables_query'}
+read_statements = {'select_query', 'explain_query', 'describe_query', 'desc_query', 'show_tables_query', 'show_stats_query', 'prepare_query', 'deallocate_query'}
+preparable_statements = {'select_query', 'insert_query', 'delete_query', 'update_tables_query'}
+
+
+def parse_statement(text):
+    # Parse normalized text of one statement, the terminating ';' may be left out
+    try:
+        tree = sql_parser.parse(text if text.endswith(';') else text + ';')
+    except exceptions.UnexpectedInput:
+        raise ProgrammingError("Syntax error") from None # SyntaxError
+    if isinstance(tree.children[0], Tree) and len(tree.children[0].children) > 1:
+        raise ProgrammingError("Only one statement can be executed at a time") # MultipleStatementError
+    return tree
+
+
+def statement_query(tree):
+    # Return tree of the query rule in parsed command, or None for exit. Query given to PREPARE is itself
+    if tree.data != 'command':
+        return tree
+    query_list = tree.children[0]
+    if isinstance(query_list, Tree):
+        return query_list.children[0].children[0]
+    return None
+
+
+def replace_placeholders(tree):
+    # Replace '?' tokens by tokens holding parameters numbered from left to right, return the parameters
+    parameters = []
+    for subtree in tree.iter_subtrees_topdown():
+        for i, child in enumerate(subtree.children):
+            if isinstance(child, Token) and child.type == 'PARAM':
+                subtree.children[i] = Token('PARAM', Parameter(len(parameters)))
+                parameters.append(subtree.children[i].value)
+    return parameters
+
+
+def value_literal_type(value):
+    # Literal type of a Python value bound to a parameter, None when it has no literal type
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, date):
+        return 'date'
+    return None
+
+
+def parameter_item(value):
+    # Return inserted (type, value) of a value bound to a parameter
+    if value is None:
+        return 'null', None
+    return value_literal_type(value), value
+
+
+def bind_inserted(inserted):
+    return [parameter_item(item.value) if isinstance(item, Parameter) else item for item in inserted]
+
+
+def bound_value(value):
+    return value.value if isinstance(value, Parameter) else value
+
+
+def open_environment():
+    # Environment in DB directory with shared buffer pool, locking and write ahead log, used by many threads.
+    # Pages keep versions for snapshot reads. Recovery runs on open, so that transactions committed before a crash are redone
+    dbEnv = db.DBEnv()
+    dbEnv.set_flags(db.DB_MULTIVERSION, 1)
+    dbEnv.set_cachesize(cache_size // (1 << 30), cache_size % (1 << 30))
+    dbEnv.set_lk_detect(db.DB_LOCK_DEFAULT)
+    dbEnv.set_lk_max_locks(max_locks)
+    dbEnv.set_lk_max_objects(max_locks)
+    dbEnv.log_set_config(db.DB_LOG_AUTO_REMOVE, True)
+    dbEnv.open('DB', db.DB_CREATE | db.DB_INIT_TXN | db.DB_INIT_LOG | db.DB_INIT_MPOOL | db.DB_INIT_LOCK | db.DB_RECOVER | db.DB_THREAD)
+    return dbEnv
+
+
+def close_environment(dbEnv):
+    dbEnv.txn_checkpoint()
+    dbEnv.close()
+
+
+def insert_row_converter(schema, insert_column_names):
+    # Check inserted column names once for a batch of rows. Return function converting a list of
+    # inserted (type, value) into typed row in table column order, where type is the literal type,
+    # 'null', or None for text which is converted by column type. Return None when names are invalid
+    column_names = schema.column_names
+    if insert_column_names is None:
+        insert_column_names = column_names
+    elif len(insert_column_names) != len(column_names) or len(set(insert_column_names)) != len(column_names):
+        raise DataError("Insertion has failed: Types are not matched") # InsertTypeMismatchError
+
+    # (column index, column name, column type, literal type, is nullable) of each inserted position
+    checks = []
+    for insert_column_name in insert_column_names:
+        if insert_column_name not in schema.column_type:
+            raise ProgrammingError(f"Insertion has failed: '{insert_column_name}' does not exist") # InsertColumnExistenceError
+        column_type = schema.column_type[insert_column_name]
+        literal_type = 'str' if 'char' in column_type else column_type
+        is_nullable = insert_column_name not in schema.primary_key and insert_column_name not in schema.not_null
+        checks.append((column_names.index(insert_column_name), insert_column_name, column_type, literal_type, is_nullable))
+
+    def convert_row(inserted):
+        if len(inserted) != len(checks):
+            raise DataError("Insertion has failed: Types are not matched") # InsertTypeMismatchError
+        row = [None] * len(checks)
+        for (idx, column_name, column_type, literal_type, is_nullable), (inserted_type, value) in zip(checks, inserted):
+            # Check not null constraint
+            if inserted_type == 'null':
+                if not is_nullable:
+                    raise IntegrityError(f"Insertion has failed: '{column_name}' is not nullable") # InsertColumnNonNullableError
+                continue
+
+            # Check column types
+            if inserted_type is not None and inserted_type != literal_type:
+                raise DataError("Insertion has failed: Types are not matched") # InsertTypeMismatchError
+            try:
+                row[idx] = parse_insert_value(value, inserted_type, column_type)
+            except ValueError:
+                raise DataError("Insertion has failed: Types are not matched") # InsertTypeMismatchError
+        return row
+    return convert_row
+
+
+def convert_assigned_value(schema, column_name, assigned_type, value):
+    # Convert value assigned by update into typed value of the column, checking types and not null constraint
+    column_type = schema.column_type[column_name]
+    if assigned_type == 'null':
+        if column_name in schema.primary_key or column_name in schema.not_null:
+            raise IntegrityError(f"Update has failed: '{column_name}' is not nullable") # UpdateColumnNonNullableError
+        return None
+    if assigned_type != ('str' if 'char' in column_type else column_type):
+        raise DataError("Update has failed: Types are not matched") # UpdateTypeMismatchError
+    try:
+        return parse_insert_value(value, assigned_type, column_type)
+    except ValueError:
+        raise DataError("Update has failed: Types are not matched") # UpdateTypeMismatchError
 
-        # Compare column types and existence and check not null constraint
-        if has_column_names:
-            for i, insert_column_name in enumerate(insert_column_names):
 
-                # Check column existence
-                if not metaDB.exists(insert_column_name.encode()):
-                    print(f"{prompt_msg}Insertion has failed: '{insert_column_name}' does not exist") # InsertColumnExistenceError
-                    return
-                
-                column_type = metaDB.get(insert_column_name.encode()).decode()
-                inserted_type = inserted_types[i]
-                
-                # Check not null constraint
-                if inserted_type == 'null' and (insert_column_name in primary_key or insert_column_name in not_null):
-                    print(f"{prompt_msg}Insertion has failed: '{insert_column_name}' is not nullable")
-                    return
-                
-                # Check column types
-                if 'char' in column_type:
-                    column_type = 'str'
-                if inserted_type != 'null' and column_type != inserted_type:
-                    print(f"{prompt_msg}Insertion has failed: Types are not matched") # InsertTypeMismatchError
-                    return
-        else: # When insert has no column names
-            for i, table_column_name in enumerate(column_names):
-                table_column_type = metaDB.get(table_column_name.encode()).decode()
-                inserted_type = inserted_types[i]
-
-                # Check not null constraint
-                if inserted_type == 'null' and (table_column_name in primary_key or table_column_name in not_null):
-                    print(f"{prompt_msg}Insertion has failed: '{table_column_name}' is not nullable") # InsertColumnNonNullableError
-                    return
-                
-                # Check column types
-                if 'char' in table_column_type:
-                    table_column_type = 'str'
-                if inserted_type != 'null' and table_column_type != inserted_type:
-                    print(inserted_type)
-                    print(f"{prompt_msg}Insertion has failed: Types are not matched") # InsertTypeMismatchError
-                    return
-
-        # When no error occured, insert values
-        mainDB = db.DB()
-        mainDB.open(table_path, dbtype=db.DB_HASH, flags=db.DB_CREATE)
-
-        if has_column_names:
-            for i, (value, insert_column_name) in enumerate(zip(inserted_values, insert_column_names)):
-                column_type = metaDB.get(insert_column_name.encode()).decode()
-                if 'char' in column_type:
-                    char_len = int(column_type[4:])
-                    inserted_values[i] = value[:char_len]
-            insert_values = []
-            for column_name in column_names:
-                i = insert_column_names.index(column_name)
-                insert_values.append(inserted_values[i])
-            mainDB.put('COLUMN'.join(insert_values).encode(), ''.encode())
-        else: # When insert has no column names
-            for i, (value, column_name) in enumerate(zip(inserted_values, column_names)):
-                column_type = metaDB.get(column_name.encode()).decode()
-                if 'char' in column_type:
-                    char_len = int(column_type[4:])
-                    inserted_values[i] = value[:char_len]
-            mainDB.put('COLUMN'.join(inserted_values).encode(), ''.encode())
-
-        # Insert success
-        print(f"{prompt_msg}The row is inserted")
-        metaDB.close()
-        mainDB.close()
-        return
+def undecodable_line(file_path, encoding):
+    # Return number of the first line of the file which is not text in encoding. Text is decoded
+    # in blocks while reading, so the reader does not know the line which failed
+    with open(file_path, 'rb') as file:
+        for line_number, line in enumerate(file, 1):
+            try:
+                line.decode(encoding)
+            except UnicodeDecodeError:
+                return line_number
+
+
+def insert_rows(session, schema, batches):
+    # Write batches of typed rows through one table handle in a child transaction, each batch in
+    # key order. Index entries are collected and put sorted by index key after all rows.
+    # Return number of inserted rows, nothing is inserted when a row fails
+    session.begin_statement()
+    txn = session.txn
+    mainDB = session.pool.table(schema.table_name)
+    column_types, primary_key_indices, codec = schema.column_types, schema.primary_key_indices, schema.codec
+    index_entries = [[] for _ in schema.indexes]
+    insert_count = 0
+    foreign_key_probes = parent_key_probes(session, schema)
+    try:
+        if not primary_key_indices:
+            row_id = struct.unpack('>Q', next_row_id(mainDB, txn))[0]
+        for rows in batches:
+            if primary_key_indices:
+                keyed_rows = sorted(((encode_primary_key(row, primary_key_indices, column_types), row) for row in rows), key=operator.itemgetter(0))
+            else:
+                keyed_rows = [(struct.pack('>Q', row_id + i), row) for i, row in enumerate(rows)]
+                row_id += len(keyed_rows)
+            if foreign_key_probes and not has_parent_rows(session, foreign_key_probes, [row for _, row in keyed_rows]):
+                raise IntegrityError("Insertion has failed: Referential integrity violation") # InsertReferentialIntegrityError
+
+            # Row is keyed by primary key, so duplication is detected by the put itself
+            for row_key, row in keyed_rows:
+                mainDB.put(row_key, codec.encode(row), txn=txn, flags=db.DB_NOOVERWRITE)
+                for entries, (_, index_indices) in zip(index_entries, schema.indexes):
+                    entries.append((secondary_index_key(row, index_indices, column_types), row_key))
+            insert_count += len(keyed_rows)
+
+        for entries, (index_name, _) in zip(index_entries, schema.indexes):
+            indexDB = session.pool.index(schema.table_name, index_name)
+            entries.sort()
+            for key, row_key in entries:
+                indexDB.put(key, row_key, txn=txn)
+    except db.DBKeyExistError:
+        session.end_statement(False)
+        raise IntegrityError("Insertion has failed: Primary key duplication") # InsertDuplicatePrimaryKeyError
+    except BaseException:
+        session.end_statement(False)
+        raise
+    session.end_statement(True)
+    return insert_count
+
+
+def update_rows(session, schema, predicate, access_path, assignments, scan):
+    # Assign values to rows satisfying predicate in a child transaction. Rows keep their key unless
+    # primary key is assigned, and are then rewritten in place during one cursor pass over the table
+    # or the rows found through access path. Otherwise rows are collected and moved to their new key,
+    # except rows referenced by other tables. Only indexes on assigned columns are maintained.
+    # scan is the plan node counting rows read for EXPLAIN ANALYZE.
+    # Return (number of updated rows, number of kept rows), nothing is updated when a row fails
+    session.begin_statement()
+    txn, table_name = session.txn, schema.table_name
+    column_types, primary_key_indices, codec = schema.column_types, schema.primary_key_indices, schema.codec
+    mainDB = session.pool.table(table_name)
+    is_key_assigned = any(idx in assignments for idx in primary_key_indices)
+    indexDBs = [(session.pool.index(table_name, index_name), index_indices) for index_name, index_indices in schema.indexes
+                if is_key_assigned or any(idx in assignments for idx in index_indices)]
+    foreign_key_probes = [probe for probe, (foreign_key, _, _) in zip(parent_key_probes(session, schema), schema.foreign_keys)
+                          if any(schema.column_names.index(column_name) in assignments for column_name in foreign_key)]
+    updated_rows, update_count, referenced_count = [], 0, 0
+
+    def assign(value):
+        new_value = list(value)
+        for idx, assigned_value in assignments.items():
+            new_value[idx] = assigned_value
+        return new_value
+
+    def update_indexes(key, value, new_key, new_value):
+        for indexDB, index_indices in indexDBs:
+            if key != new_key or secondary_index_key(value, index_indices, column_types) != secondary_index_key(new_value, index_indices, column_types):
+                delete_secondary_index(indexDB, txn, index_indices, column_types, value, key)
+                put_secondary_index(indexDB, txn, index_indices, column_types, new_value, new_key)
+
+    def read_rows():
+        if access_path:
+            return scan.output(scan.read(access_path(), access_path.access[1]))
+        return scan.output((key, codec.decode(value)) for key, value in scan.read(table_items(mainDB, txn)))
 
+    try:
+        if is_key_assigned:
+            row_items = [(key, value, assign(value)) for key, value in read_rows() if predicate(value)]
+            row_items = [(key, value, encode_primary_key(new_value, primary_key_indices, column_types), new_value) for key, value, new_value in row_items]
+
+            # Rows whose key changes while other tables reference it are kept
+            if schema.reference_count:
+                moved = [i for i, (key, _, new_key, _) in enumerate(row_items) if key != new_key]
+                referenced = {moved[i] for i in find_referenced_rows(session, schema, [row_items[i][1] for i in moved])}
+                referenced_count = len(referenced)
+                row_items = [row_item for i, row_item in enumerate(row_items) if i not in referenced]
+
+            # All old keys are removed first, so that rows can take keys freed by each other
+            for key, _, _, _ in row_items:
+                mainDB.delete(key, txn=txn)
+            for key, value, new_key, new_value in row_items:
+                mainDB.put(new_key, codec.encode(new_value), txn=txn, flags=db.DB_NOOVERWRITE)
+                update_indexes(key, value, new_key, new_value)
+                updated_rows.append(new_value)
+            update_count = len(row_items)
+        elif access_path:
+            # Rows found through index are collected first, since the index may be modified below
+            for key, value in list(read_rows()):
+                if predicate(value):
+                    new_value = assign(value)
+                    mainDB.put(key, codec.encode(new_value), txn=txn)
+                    update_indexes(key, value, key, new_value)
+                    updated_rows.append(new_value)
+                    update_count += 1
+        else:
+            # Rows are rewritten through the cursor reading them, so they are counted here
+            counted, start = scan.instrumented, time.perf_counter()
+            scan.calls_per_item = 1
+            cursor = mainDB.cursor(txn)
+            try:
+                x = cursor.next()
+                while x:
+                    scan.scanned += 1
+                    if counted:
+                        scan.rows += 1
+                    key, value = x[0], codec.decode(x[1])
+                    if predicate(value):
+                        new_value = assign(value)
+                        cursor.put(key, codec.encode(new_value), db.DB_CURRENT)
+                        update_indexes(key, value, key, new_value)
+                        updated_rows.append(new_value)
+                        update_count += 1
+                    x = cursor.next()
+            finally:
+                cursor.close()
+            if counted:
+                scan.ran, scan.seconds = True, time.perf_counter() - start
+
+        if foreign_key_probes and not has_parent_rows(session, foreign_key_probes, updated_rows):
+            raise IntegrityError("Update has failed: Referential integrity violation") # UpdateReferentialIntegrityError
+    except db.DBKeyExistError:
+        session.end_statement(False)
+        raise IntegrityError("Update has failed: Primary key duplication") # UpdateDuplicatePrimaryKeyError
+    except BaseException:
+        session.end_statement(False)
+        raise
+    session.end_statement(True)
+    return update_count, referenced_count
+
+
+def parent_key_probes(session, schema):
+    # Return (referenced table, referencing column indices in order of its primary key, key types)
+    # of each foreign key of the table
+    probes = []
+    for foreign_key, referenced_table_name, referenced_key in schema.foreign_keys:
+        parent_schema = session.catalog.get(referenced_table_name)
+        indices = [schema.column_names.index(foreign_key[referenced_key.index(column_name)]) for column_name in parent_schema.primary_key]
+        probes.append((referenced_table_name, indices, [schema.column_types[idx] for idx in indices]))
+    return probes
+
+
+def has_parent_rows(session, probes, rows):
+    # Check that every foreign key value of the rows exists as primary key of the referenced table.
+    # Distinct keys of the batch are probed once each in key order, rows with null in the key pass
+    for referenced_table_name, indices, key_types in probes:
+        keys = set()
+        for row in rows:
+            values = [row[idx] for idx in indices]
+            if None not in values:
+                keys.add(encode_key(values, key_types))
+        parentDB = session.pool.table(referenced_table_name)
+        for key in sorted(keys):
+            if parentDB.get(key, txn=session.txn) is None:
+                return False
+    return True
+
+
+def find_referenced_rows(session, schema, rows):
+    # Return positions of rows whose primary key is referenced by a row of another table.
+    # Distinct keys are probed in key order through index or primary key of the referencing table
+    # whose leading columns are the foreign key, or checked against one scan of it otherwise
+    txn, referenced = session.txn, set()
+    for child_schema, foreign_key_indices, referenced_key_indices in session.catalog.referencing(schema.table_name):
+        candidates = [(None, child_schema.primary_key_indices)] + child_schema.indexes
+        index = next(((index_name, index_indices) for index_name, index_indices in candidates
+                      if set(index_indices[:len(foreign_key_indices)]) == set(foreign_key_indices)), None)
+        if index:
+            index_name, index_indices = index
+            # Parent column for each leading index column
+            parent_indices = [referenced_key_indices[foreign_key_indices.index(idx)] for idx in index_indices[:len(foreign_key_indices)]]
+        else:
+            parent_indices = referenced_key_indices
+        key_types = [schema.column_types[idx] for idx in parent_indices]
+
+        keys = {}
+        for i, row in enumerate(rows):
+            keys.setdefault(encode_key([row[idx] for idx in parent_indices], key_types), []).append(i)
+        if index:
+            probeDB = session.pool.table(child_schema.table_name) if index_name is None else session.pool.index(child_schema.table_name, index_name)
+            referencing_keys = {key for key in sorted(keys) if has_key_prefix(probeDB, txn, key)}
+        else:
+            foreign_key_types = [child_schema.column_types[idx] for idx in foreign_key_indices]
+            referencing_keys = {encode_key([value[idx] for idx in foreign_key_indices], foreign_key_types)
+                                for value in scan_table(session.pool.table(child_schema.table_name), txn, child_schema.codec.decode)}
+        for key in referencing_keys & keys.keys():
+            referenced.update(keys[key])
+    return referenced
 
-    def delete_query(self, items):
-        table_name = items[2].children[0].lower()
-        table_path = 'DB/'+table_name+'.db' 
-        table_schema_path = 'DB/'+table_name+'_schema.db' 
 
-        if not os.path.exists(table_schema_path):
-            print(f"{prompt_msg}No such table") # NoSuchTable
-            return
-        
+def has_key_prefix(tableDB, txn, prefix_key):
+    cursor = tableDB.cursor(txn)
+    try:
+        x = cursor.set_range(prefix_key)
+        return bool(x) and x[0].startswith(prefix_key)
+    finally:
+        cursor.close()
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def split_schema_value(metaDB, key, separator):
+    value = metaDB.get(key.encode()).decode()
+    return value.split(separator) if value else []
+
+
+def open_btree(path, dbEnv, set_flags=0):
+    # Open B-tree file in DB directory, standalone when dbEnv is None. File names
+    # inside environment are relative to its home directory DB
+    handle = db.DB(dbEnv)
+    if set_flags:
+        handle.set_flags(set_flags)
+    if dbEnv:
+        handle.open(os.path.relpath(path, 'DB'), dbtype=db.DB_BTREE, flags=db.DB_CREATE | db.DB_AUTO_COMMIT)
+    else:
+        handle.open(path, dbtype=db.DB_BTREE, flags=db.DB_CREATE)
+    return handle
+
+
+def open_table(table_name, dbEnv=None):
+    # Table is a B-tree from primary key or row id to encoded row
+    return open_btree('DB/'+table_name+'.db', dbEnv)
+
+
+def scan_table(tableDB, txn, decode):
+    # Yield each record of the table as a list of column values
+    for _, value in table_items(tableDB, txn):
+        yield decode(value)
+
+
+def scan_table_items(tableDB, txn, decode):
+    # Yield (row key, column values) of each record of the table
+    for key, value in table_items(tableDB, txn):
+        yield key, decode(value)
+
+
+class RowCodec:
+    # Binary row layout driven by column types of the schema:
+    # null bitmap, fixed width slots of int and date columns in column order,
+    # then length prefixed utf-8 values of char columns in column order.
+    # Slots of null values are kept, so fixed width columns are always at the same offset
+    int_struct = struct.Struct('>q')
+    date_struct = struct.Struct('>i')
+    length_struct = struct.Struct('>H')
+
+    def __init__(self, column_types):
+        self.column_types = column_types
+        self.column_count = len(column_types)
+        self.bitmap_size = (self.column_count + 7) // 8
+        self.fixed_columns, self.char_columns = [], []
+        offset = self.bitmap_size
+        for idx, column_type in enumerate(column_types):
+            if column_type == 'int':
+                self.fixed_columns.append((idx, offset, self.int_struct, False))
+                offset += self.int_struct.size
+            elif column_type == 'date':
+                self.fixed_columns.append((idx, offset, self.date_struct, True))
+                offset += self.date_struct.size
+            else:
+                self.char_columns.append(idx)
+        self.fixed_size = offset
+        self.decode = self.decoder(None)
+
+    def __reduce__(self):
+        # Decoder closures are rebuilt when the codec is sent to scan workers
+        return RowCodec, (self.column_types,)
+
+    def encode(self, values):
+        bitmap = 0
+        for idx, value in enumerate(values):
+            if value is None:
+                bitmap |= 1 << idx
+        data = bytearray(self.fixed_size)
+        data[:self.bitmap_size] = bitmap.to_bytes(self.bitmap_size, 'little')
+        for idx, offset, column_struct, is_date in self.fixed_columns:
+            value = values[idx]
+            if value is not None:
+                column_struct.pack_into(data, offset, value.toordinal() if is_date else value)
+        for idx in self.char_columns:
+            value = (values[idx] or '').encode()
+            if len(value) > max_char_length:
+                raise DataError(f"Char value is longer than {max_char_length} bytes in utf-8") # CharValueLengthError
+            data += self.length_struct.pack(len(value)) + value
+        return bytes(data)
+
+    def decoder(self, indices):
+        # Return function decoding only the column slots in indices (all when None),
+        # other slots of the returned row are left as None
+        fixed_columns = [column for column in self.fixed_columns if indices is None or column[0] in indices]
+        char_columns = [(idx, indices is None or idx in indices) for idx in self.char_columns]
+        while char_columns and not char_columns[-1][1]:
+            char_columns.pop()
+        column_count, bitmap_size, fixed_size = self.column_count, self.bitmap_size, self.fixed_size
+        length_struct, fromordinal = self.length_struct, date.fromordinal
+
+        def decode(data):
+            bitmap = int.from_bytes(data[:bitmap_size], 'little')
+            values = [None] * column_count
+            for idx, offset, column_struct, is_date in fixed_columns:
+                if not bitmap >> idx & 1:
+                    value = column_struct.unpack_from(data, offset)[0]
+                    values[idx] = fromordinal(value) if is_date else value
+            offset = fixed_size
+            for idx, is_used in char_columns:
+                length = length_struct.unpack_from(data, offset)[0]
+                offset += 2
+                if is_used and not bitmap >> idx & 1:
+                    values[idx] = data[offset:offset + length].decode()
+                offset += length
+            return values
+        return decode
+
+
+def encode_key(values, column_types):
+    # Order preserving encoding of typed values for B-tree keys. Every value is prefixed
+    # with 0x00 for null or 0x01 otherwise, ints are offset into unsigned big endian,
+    # dates are big endian day ordinals and chars are utf-8 terminated by 0x00
+    data = bytearray()
+    for value, column_type in zip(values, column_types):
+        if value is None:
+            data += b'\x00'
+        elif column_type == 'int':
+            data += b'\x01' + struct.pack('>Q', value + (1 << 63))
+        elif column_type == 'date':
+            data += b'\x01' + struct.pack('>I', value.toordinal())
+        else:
+            data += b'\x01' + value.encode() + b'\x00'
+    return bytes(data)
+
+
+def decode_key(data, column_types):
+    values, offset = [], 0
+    for column_type in column_types:
+        if data[offset] == 0:
+            values.append(None)
+            offset += 1
+        elif column_type == 'int':
+            values.append(struct.unpack_from('>Q', data, offset + 1)[0] - (1 << 63))
+            offset += 9
+        elif column_type == 'date':
+            values.append(date.fromordinal(struct.unpack_from('>I', data, offset + 1)[0]))
+            offset += 5
+        else:
+            end = data.index(b'\x00', offset + 1)
+            values.append(data[offset + 1:end].decode())
+            offset = end + 1
+    return values
+
+
+def parse_insert_value(value, inserted_type, column_type):
+    # Convert inserted literal into typed value of the column, raise ValueError when invalid
+    if inserted_type == 'null':
+        return None
+    if column_type == 'int':
+        value = int(value)
+        if not -(1 << 63) <= value < (1 << 63):
+            raise ValueError(value)
+        return value
+    if column_type == 'date':
+        return value if isinstance(value, date) else date.fromisoformat(value)
+    char_len = int(column_type[4:])
+    return value[:char_len]
+
+
+def table_items(tableDB, txn):
+    cursor = tableDB.cursor(txn)
+    try:
+        while x := cursor.next():
+            yield x
+    finally:
+        cursor.close()
+
+
+def encode_primary_key(values, primary_key_indices, column_types):
+    # values is a row or a dict from column index to value
+    return encode_key([values[idx] for idx in primary_key_indices], [column_types[idx] for idx in primary_key_indices])
+
+
+def next_row_id(tableDB, txn):
+    # Rows of table without primary key are keyed by increasing 8 byte row id
+    cursor = tableDB.cursor(txn)
+    x = cursor.last()
+    cursor.close()
+    row_id = struct.unpack('>Q', x[0])[0] + 1 if x else 1
+    return struct.pack('>Q', row_id)
+
+
+def lookup_row(tableDB, txn, key, decode):
+    # Yield (row key, column values) of the record with the given key, if any
+    value = tableDB.get(key, txn=txn)
+    if value is not None:
+        yield key, decode(value)
+
+
+def parallel_scan_allowed(session, table_name):
+    # Scan workers read committed rows in snapshots of their own, so they are used only outside
+    # BEGIN ... COMMIT, where the statement's transaction has not written anything before the scan
+    return (scan_parallelism > 1 and session.snapshot_commits is not None and not session.holds_schema_lock
+            and table_size(table_name) >= parallel_scan_min_size)
+
+
+def parallel_scan(session, schema, decode_indices, conjuncts, with_keys):
+    # Return iterator of rows of the table passing conjuncts in key order, read by scan workers from key ranges.
+    # A few ranges per worker are in flight, so rows are not read much faster than they are pulled.
+    # Rows are pulled after the statement returns, so its snapshot is taken now
+    tableDB, txn, commits = session.pool.table(schema.table_name), session.txn, session.snapshot_commits
+    executor = session.database.scan_pool()
+
+    def partition_rows(key_range, future):
+        # Worker returns None when a commit began before its snapshot, then the range is read in the statement's snapshot
+        rows = future.result()
+        return rows if rows is not None else filter_range(schema, tableDB, txn, decode_indices, conjuncts, *key_range, with_keys)
+
+    def rows():
+        pending = deque()
+        try:
+            for key_range in partition_key_ranges(tableDB, txn, scan_parallelism * 4):
+                pending.append((key_range, executor.submit(scan_partition, schema, decode_indices, conjuncts, *key_range, with_keys, commits)))
+                if len(pending) > scan_parallelism * 2:
+                    yield from partition_rows(*pending.popleft())
+            while pending:
+                yield from partition_rows(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+    return rows()
+
+
+def partition_key_ranges(tableDB, txn, count):
+    # Split keys between the first and the last key into count [lower, upper) ranges, None is unbounded.
+    # Bounds interpolate 8 bytes after the common prefix of the two keys, which is even for row ids
+    cursor = tableDB.cursor(txn)
+    first, last = cursor.first(), cursor.last()
+    cursor.close()
+    if not first:
+        return []
+    first, last = first[0], last[0]
+    common = len(os.path.commonprefix([first, last]))
+    low = int.from_bytes(first[common:common + 8].ljust(8, b'\0'), 'big')
+    high = int.from_bytes(last[common:common + 8].ljust(8, b'\0'), 'big')
+    bounds = sorted({first[:common] + (low + (high - low) * i // count).to_bytes(8, 'big') for i in range(1, count)})
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+# Environment joined by a scan worker process and number of started commits of the database
+scan_worker_environment, scan_worker_commits = None, None
+
+
+def start_scan_worker(commits_started):
+    global scan_worker_environment, scan_worker_commits
+    scan_worker_environment = db.DBEnv()
+    scan_worker_environment.open('DB', db.DB_JOINENV | db.DB_THREAD)
+    scan_worker_commits = commits_started
+
+
+def scan_partition(schema, decode_indices, conjuncts, lower, upper, with_keys, commits):
+    # Run in a scan worker: return rows of filter_range read in a snapshot holding commits commits,
+    # or None when another commit began before the snapshot and may be in it
+    tableDB = open_table(schema.table_name, scan_worker_environment)
+    txn = scan_worker_environment.txn_begin(flags=db.DB_TXN_SNAPSHOT)
+    try:
+        if scan_worker_commits.value != commits:
+            return None
+        return filter_range(schema, tableDB, txn, decode_indices, conjuncts, lower, upper, with_keys)
+    finally:
+        txn.commit()
+        tableDB.close()
+
+
+def filter_range(schema, tableDB, txn, decode_indices, conjuncts, lower, upper, with_keys):
+    # Decode rows with keys in [lower, upper) and return the ones passing conjuncts, as (row key, column values)
+    # when with_keys. Conjuncts are trees compiled here, with parameters bound
+    decode = schema.codec.decoder(decode_indices)
+    batch_filter, other_conjuncts = compile_batch_filter(conjuncts, schema)
+    predicate = compile_conjuncts(other_conjuncts, schema)
+    items = range_items(tableDB, txn, lower, upper)
+    try:
+        if batch_filter:
+            return list(batch_filter_rows(items, batch_filter, decode, predicate, with_keys))
+        rows = []
+        for key, data in items:
+            value = decode(data)
+            if predicate is None or predicate(value):
+                rows.append((key, value) if with_keys else value)
+        return rows
+    finally:
+        items.close()
+
+
+def range_items(tableDB, txn, lower, upper):
+    # Yield (key, data) of records with keys in [lower, upper), None is unbounded
+    cursor = tableDB.cursor(txn)
+    try:
+        x = cursor.set_range(lower) if lower else cursor.first()
+        while x and (upper is None or x[0] < upper):
+            yield x
+            x = cursor.next()
+    finally:
+        cursor.close()
+
+
+def collect_statistics(rows, column_types):
+    # Read rows once, keeping a uniform sample of rows for the histograms and the smallest hashes
+    # of each column for the estimates of distinct values
+    sampler = random.Random(0)
+    sample, row_count, nulls = [], 0, [0] * len(column_types)
+    sketches, sketch_members = [[] for _ in column_types], [set() for _ in column_types]
+    for row in rows:
+        row_count += 1
+        if len(sample) < statistics_sample_size:
+            sample.append(row)
+        elif (i := sampler.randrange(row_count)) < statistics_sample_size:
+            sample[i] = row
+        for idx, value in enumerate(row):
+            if value is None:
+                nulls[idx] += 1
+                continue
+            value_hash, sketch, members = stable_hash(value), sketches[idx], sketch_members[idx]
+            if value_hash in members:
+                continue
+            if len(sketch) < distinct_sketch_size:
+                heapq.heappush(sketch, -value_hash)
+                members.add(value_hash)
+            elif value_hash < -sketch[0]:
+                members.discard(-heapq.heapreplace(sketch, -value_hash))
+                members.add(value_hash)
+
+    columns = []
+    for idx, column_type in enumerate(column_types):
+        values = sorted(row[idx].toordinal() if column_type == 'date' else row[idx] for row in sample if row[idx] is not None)
+        bounds = [values[i * (len(values) - 1) // histogram_buckets] for i in range(histogram_buckets + 1)] if values else []
+        sketch = sketches[idx]
+        distinct = len(sketch) if len(sketch) < distinct_sketch_size else round((distinct_sketch_size - 1) * (1 << 64) / -sketch[0])
+        columns.append({'nulls': nulls[idx] / row_count if row_count else 0.0, 'distinct': distinct, 'bounds': bounds})
+    return {'row_count': row_count, 'columns': columns}
+
+
+def stable_hash(value):
+    # 64 bit hash which is uniform also for small ints
+    return int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), 'big')
+
+
+def migrate_tables():
+    # Rewrite tables written by older versions into current layout:
+    # format 1 is hash file keyed by the whole 'COLUMN' separated row string with an empty value,
+    # format 2 is B-tree keyed by primary key or row id with 'COLUMN' separated row string as value
+    for table_schema_path in glob('DB/*_schema.db'):
+        table_name = os.path.basename(table_schema_path)[:-len('_schema.db')]
         metaDB = db.DB()
         metaDB.open(table_schema_path, dbtype=db.DB_HASH)
-        mainDB = db.DB()
-        mainDB.open(table_path, dbtype=db.DB_HASH)
+        try:
+            storage_format = metaDB.get('storage_format'.encode())
+            if storage_format is None or storage_format.decode() != storage_format_version:
+                migrate_table(table_name, metaDB, storage_format.decode() if storage_format else '1')
+                metaDB.put('storage_format'.encode(), storage_format_version.encode())
+        finally:
+            metaDB.close()
 
-        delete_count = 0
-        # When where clause exists
-        if items[3]:
-            column_types, table_column_names = [], []
-            column_names = metaDB.get('column_names'.encode()).decode().split('COLUMN')
-            for column_name in column_names:
-                column_type = metaDB.get(column_name.encode()).decode()
-                column_types.append(column_type)
-                table_column_names.append((table_name, column_name))
-            cursor = mainDB.cursor()
-            while x := cursor.next():
-                key, _ = x
-                value = key.decode().split('COLUMN')
-
-                # Evaluate and delete record if result is true
-                try: 
-                    if evaluate_bool_expr(items[3].children[1], value, column_names, column_types, table_column_names):
-                        mainDB.delete(key)
-                        delete_count += 1
-                except:
-                    return
-        else: # When where clause not exists
-            cursor = mainDB.cursor()
-            while x := cursor.next():
-                key, _ = x
-                mainDB.delete(key)
-                delete_count += 1
 
-        # Delete Success        
-        print(f"{prompt_msg}{delete_count} row(s) are deleted")
-        metaDB.close()
-        mainDB.close()
+def migrate_table(table_name, metaDB, storage_format):
+    # Files of the table are replaced only after all rows are rewritten, so a failed migration
+    # leaves the table in its old format
+    table_path = 'DB/'+table_name+'.db'
+    if not os.path.exists(table_path):
+        remove_old_primary_key_index(table_name)
         return
+    column_names = metaDB.get('column_names'.encode()).decode().split('COLUMN')
+    column_types = [metaDB.get(column_name.encode()).decode() for column_name in column_names]
+    primary_key = metaDB.get('primary_key'.encode()).decode()
+    primary_key_indices = [column_names.index(column_name) for column_name in primary_key.split('COLUMN')] if primary_key else []
+    codec = RowCodec(column_types)
+
+    oldDB = db.DB()
+    oldDB.open(table_path, dbtype=db.DB_HASH if storage_format == '1' else db.DB_BTREE)
+    newDB = db.DB()
+    newDB.open(table_path+'.migrating', dbtype=db.DB_BTREE, flags=db.DB_CREATE)
+    row_id, duplicate_keys = 0, []
+    old_items = table_items(oldDB, None)
+    try:
+        for row_number, (old_key, old_value) in enumerate(old_items, 1):
+            text_values = (old_key if storage_format == '1' else old_value).decode().split('COLUMN')
+            value = []
+            for text_value, column_name, column_type in zip(text_values, column_names, column_types):
+                # Older versions checked only the shape of values, so stored text may not be a value of its type
+                try:
+                    value.append(parse_stored_text(text_value, column_type))
+                except ValueError:
+                    raise OperationalError(f"Migration of '{table_name}' has failed: row {row_number} has '{text_value}' "
+                                           f"in column '{column_name}', which is not a valid {column_type}") # MigrationValueError
+            if primary_key_indices:
+                key = encode_primary_key(value, primary_key_indices, column_types)
+            else:
+                row_id += 1
+                key = struct.pack('>Q', row_id)
 
-    def update_tables_query(self, items):
-        print(f"{prompt_msg}\'UPDATE\' requested")
+            # Older versions did not enforce primary keys, rows sharing a key are reported instead of overwritten
+            try:
+                newDB.put(key, codec.encode(value), flags=db.DB_NOOVERWRITE)
+            except db.DBKeyExistError:
+                duplicate_keys.append('(' + ', '.join(text_values[idx] for idx in primary_key_indices) + ')')
+        if duplicate_keys:
+            raise OperationalError(f"Migration of '{table_name}' has failed: {len(duplicate_keys)} row(s) duplicate primary key "
+                                   f"{', '.join(duplicate_keys[:10])}{' ...' if len(duplicate_keys) > 10 else ''}") # MigrationDuplicatePrimaryKeyError
+    except BaseException:
+        old_items.close()
+        oldDB.close()
+        newDB.close()
+        os.remove(table_path+'.migrating')
+        raise
+    oldDB.close()
+    newDB.close()
+    os.replace(table_path+'.migrating', table_path)
+    remove_old_primary_key_index(table_name)
+
+    # Secondary indexes point to the old row keys with old key encoding, so rebuild them
+    tableDB = open_table(table_name)
+    for index_name, index_indices in read_indexes(metaDB, column_names):
+        indexDB = open_secondary_index(table_name, index_name)
+        indexDB.truncate()
+        for key, value in scan_table_items(tableDB, None, codec.decode):
+            put_secondary_index(indexDB, None, index_indices, column_types, value, key)
+        indexDB.close()
+    tableDB.close()
+
+
+def remove_old_primary_key_index(table_name):
+    # Format 1 kept primary key values in a file of their own
+    if os.path.exists('DB/'+table_name+'_pk.db'):
+        os.remove('DB/'+table_name+'_pk.db')
+
+
+def parse_stored_text(text_value, column_type):
+    # Older formats stored null as the text 'null'. Raise ValueError when the text is not a value
+    # of the column type the current layout can hold
+    if text_value.lower() == 'null':
+        return None
+    if column_type == 'int':
+        return parse_insert_value(text_value, 'int', column_type)
+    if column_type == 'date':
+        return date.fromisoformat(text_value)
+    if len(text_value.encode()) > max_char_length:
+        raise ValueError(text_value)
+    return text_value
+
+
+def read_indexes(metaDB, column_names):
+    # Return list of (index name, column indices) stored in table schema
+    indexes = []
+    index_list = metaDB.get('indexes'.encode())
+    if index_list:
+        for index in index_list.decode().split('INDEX'):
+            index_name, index_columns = index.split('ON')
+            indexes.append((index_name, [column_names.index(column_name) for column_name in index_columns.split('COLUMN')]))
+    return indexes
+
+
+def secondary_index_path(table_name, index_name):
+    return 'DB/'+table_name+'_'+index_name+'_index.db'
+
+
+def open_secondary_index(table_name, index_name, dbEnv=None):
+    # Secondary index is a B-tree with duplicates from encoded column values to row key
+    return open_btree(secondary_index_path(table_name, index_name), dbEnv, db.DB_DUP)
+
+
+def secondary_index_key(value, index_indices, column_types):
+    return encode_key([value[idx] for idx in index_indices], [column_types[idx] for idx in index_indices])
+
+
+def put_secondary_index(indexDB, txn, index_indices, column_types, value, row_key):
+    indexDB.put(secondary_index_key(value, index_indices, column_types), row_key, txn=txn)
+
+
+def delete_secondary_index(indexDB, txn, index_indices, column_types, value, row_key):
+    cursor = indexDB.cursor(txn)
+    if cursor.set_both(secondary_index_key(value, index_indices, column_types), row_key):
+        cursor.delete()
+    cursor.close()
+
+
+def scan_secondary_index(tableDB, indexDB, txn, index_types, prefix, lower, upper, decode):
+    # Yield (row key, column values) of records whose leading index columns equal prefix
+    # and next column is within bounds. lower and upper are (value, is_strict) or None
+    cursor = indexDB.cursor(txn)
+    try:
+        start = prefix + [lower[0]] if lower else prefix
+        prefix_key = encode_key(prefix, index_types)
+        x = cursor.set_range(encode_key(start, index_types))
+        while x:
+            key, row_key = x
+            if not key.startswith(prefix_key):
+                break
+            if lower or upper:
+                value = decode_key(key, index_types[:len(prefix) + 1])[-1]
+                # Nulls are ordered first and never satisfy a range
+                if value is None or (lower and lower[1] and value == lower[0]):
+                    x = cursor.next()
+                    continue
+                if upper and (value > upper[0] or (upper[1] and value == upper[0])):
+                    break
+            yield row_key, decode(tableDB.get(row_key, txn=txn))
+            x = cursor.next()
+    finally:
+        cursor.close()
+
+
+def plan_access_path(session, table_name, primary_key_indices, indexes, conjuncts, column_names, column_types, table_column_names, decode, statistics=None):
+    # Return callable yielding (row key, column values) of candidate records through primary key
+    # or secondary index, or None when the table has to be scanned. Candidates still have to be filtered
+    pool = session.pool
+    equal_values = find_equal_values(conjuncts, column_names, column_types, table_column_names)
+    if primary_key_indices and all(idx in equal_values for idx in primary_key_indices):
+        if not any(isinstance(equal_values[idx], Parameter) for idx in primary_key_indices):
+            key = encode_primary_key(equal_values, primary_key_indices, column_types)
+            lookup = lambda: lookup_row(pool.table(table_name), session.txn, key, decode)
+            lookup.access = ("Primary Key Lookup", 1, None)
+            return lookup
+
+        # Key of a prepared statement is encoded from the values bound for each execution
+        def lookup_bound_row():
+            values = {idx: bound_value(equal_values[idx]) for idx in primary_key_indices}
+            if None in values.values():
+                return iter(())
+            return lookup_row(pool.table(table_name), session.txn, encode_primary_key(values, primary_key_indices, column_types), decode)
+        lookup_bound_row.access = ("Primary Key Lookup", 1, None)
+        return lookup_bound_row
+
+    # Choose index with longest equality prefix, preferring one with range on next column
+    range_values = find_range_values(conjuncts, column_names, column_types, table_column_names)
+    best, best_score = None, (0, False)
+    for index_name, index_indices in indexes:
+        prefix = []
+        for idx in index_indices:
+            if idx not in equal_values:
+                break
+            prefix.append(equal_values[idx])
+        next_idx = index_indices[len(prefix)] if len(prefix) < len(index_indices) else None
+        score = (len(prefix), next_idx in range_values)
+        if score > best_score:
+            best, best_score = (index_name, prefix, next_idx), score
+    if best is None:
+        return None
+
+    index_name, prefix, next_idx = best
+    index_types = [column_types[idx] for idx in dict(indexes)[index_name]]
+    ranges = range_values.get(next_idx, [])
+
+    # Scan reads pages in order, so it is cheaper than an index returning a large part of an analyzed table
+    if statistics:
+        fraction = 1.0
+        for idx, value in zip(dict(indexes)[index_name], prefix):
+            fraction *= statistics.selectivity(idx, '=', value)
+        for op, value in ranges:
+            fraction *= statistics.selectivity(next_idx, op, None if isinstance(value, Parameter) else value)
+        if fraction > index_selectivity_threshold:
+            return None
+
+    # Bounds are taken when the plan runs, since values of a prepared statement are bound for each execution
+    def scan_index():
+        values = [bound_value(value) for value in prefix]
+        lower, upper = None, None
+        for op, value in ranges:
+            value = bound_value(value)
+            if value is None:
+                return iter(())
+            if op in ('>', '>='):
+                bound = (value, op == '>')
+                lower = max(lower, bound) if lower else bound
+            else:
+                bound = (value, op == '<')
+                upper = min(upper, bound, key=lambda bound: (bound[0], not bound[1])) if upper else bound
+        if None in values:
+            return iter(())
+        return scan_secondary_index(pool.table(table_name), pool.index(table_name, index_name), session.txn, index_types, values, lower, upper, decode)
+
+    # (name shown by EXPLAIN, storage calls per row, index name) describe the access path
+    scan_index.access = (f"Index Scan using {index_name}", 2, index_name)
+    return scan_index
+
+
+def nested_loop_rows(outer_rows, inner_rows):
+    # Rescan inner input for every outer row instead of materializing the product
+    for outer_row in outer_rows:
+        for inner_row in inner_rows():
+            yield outer_row + inner_row
+
+
+def hash_join_rows(left_rows, right_rows, left_key, right_key, build_left):
+    # Build hash table on one input and probe it with the other, output rows are always left + right
+    if build_left:
+        build_rows, probe_rows, build_key, probe_key = left_rows, right_rows, left_key, right_key
+    else:
+        build_rows, probe_rows, build_key, probe_key = right_rows, left_rows, right_key, left_key
+
+    hash_table, used = {}, 0
+    build_rows = iter(build_rows)
+    for row in build_rows:
+        key = tuple(row[idx] for idx in build_key)
+        # Null never equals anything, so such rows can not join
+        if None in key:
+            continue
+        hash_table.setdefault(key, []).append(row)
+        used += row_size(row)
+        # When build side exceeds memory budget, spill everything into partitions
+        if used > hash_join_memory_budget:
+            spilled_rows = chain((row for bucket in hash_table.values() for row in bucket), build_rows)
+            yield from grace_hash_join_rows(spilled_rows, probe_rows, build_key, probe_key, build_left, 0)
+            return
 
+    for row in probe_rows:
+        matches = hash_table.get(tuple(row[idx] for idx in probe_key))
+        if matches:
+            for match in matches:
+                yield match + row if build_left else row + match
 
-def evaluate_bool_expr(tree, value, column_names, column_types, table_column_names):
-    booleans = []
-    for i, child in enumerate(tree.children):
-        # Odd children are 'or', so just add even children
-        if i % 2 == 0:
-            booleans.append(evaluate_bool_term(child, value, column_names, column_types, table_column_names))
-    return any(booleans)
 
+def grace_hash_join_rows(build_rows, probe_rows, build_key, probe_key, build_left, level):
+    # Partition both inputs on disk by hash of join key, then join each partition pair in memory
+    tmp_dir = tempfile.mkdtemp(prefix='join_', dir='DB')
+    try:
+        build_paths = write_partitions(build_rows, build_key, tmp_dir, 'build', level)
+        probe_paths = write_partitions(probe_rows, probe_key, tmp_dir, 'probe', level)
+        for build_path, probe_path in zip(build_paths, probe_paths):
+            hash_table, used = {}, 0
+            for row in read_partition(build_path):
+                hash_table.setdefault(tuple(row[idx] for idx in build_key), []).append(row)
+                used += row_size(row)
+
+            # Partition that is still too large is split again with another hash
+            if used > hash_join_memory_budget and level < 3 and len(hash_table) > 1:
+                hash_table = None
+                yield from grace_hash_join_rows(read_partition(build_path), read_partition(probe_path), build_key, probe_key, build_left, level + 1)
+                continue
+
+            for row in read_partition(probe_path):
+                matches = hash_table.get(tuple(row[idx] for idx in probe_key))
+                if matches:
+                    for match in matches:
+                        yield match + row if build_left else row + match
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_partitions(rows, key, tmp_dir, side, level):
+    paths = [os.path.join(tmp_dir, f'{side}{level}_{i}') for i in range(grace_partition_count)]
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for row in rows:
+            row_key = tuple(row[idx] for idx in key)
+            if None in row_key:
+                continue
+            partition = hash((level,) + row_key) % grace_partition_count
+            pickle.dump(row, files[partition])
+    finally:
+        for file in files:
+            file.close()
+    return paths
 
-def evaluate_bool_term(tree, value, column_names, column_types, table_column_names):
-    booleans = []
-    for i, child in enumerate(tree.children):
-        # Odd children are 'and', so just add even children
-        if i % 2 == 0:
-            booleans.append(evaluate_bool_factor(child, value, column_names, column_types, table_column_names))
-    return all(booleans)
 
+def read_partition(path):
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
 
-def evaluate_bool_factor(tree, value, column_names, column_types, table_column_names,):
-    is_not = True if tree.children[0] else False
-    if tree.children[1].children[0].data == 'predicate':
-        if tree.children[1].children[0].children[0].data == 'comparison_predicate':
-            comp_operand_iter = tree.children[1].children[0].children[0].find_data('comp_operand')
-            comp_operand1 = next(comp_operand_iter)
-            comp_operand2 = next(comp_operand_iter)
-
-            if comp_operand1.children[0] != None and comp_operand1.children[0].data == 'comparable_value':
-                comp_operand1_value = comp_operand1.children[0].children[0]
-                comp_operand1_type = comp_operand1.children[0].children[0].type
-            else: # When operand is column
-                column1 = comp_operand1.children[1].children[0]
-                if comp_operand1.children[0]:
-                    table1 = comp_operand1.children[0].children[0]
-                else:
-                    table1 = ''
-                if table1:
-                    if column1 not in column_names:
-                        print(f"{prompt_msg}Where clause trying to reference non existing column") # WhereColumnNotExist
-                        raise
-                    elif (table1, column1) not in table_column_names:
-                        print(f"{prompt_msg}Where clause trying to reference tables which are not specified") # WhereTableNotSpecified
-                        raise
-                    else:
-                        idx = table_column_names.index((table1, column1))
-                        comp_operand1_value = value[idx]
-                        comp_operand1_type = column_types[idx].lower()
-                else:
-                    if column1 not in column_names:
-                        print(f"{prompt_msg}Where clause trying to reference non existing column") # WhereColumnNotExist
-                        raise
-                    elif column_names.count(column1) > 1:
-                        print(f"{prompt_msg}Where clause contains ambiguous reference") # WhereAmbiguousReference
-                        raise
-                    else:
-                        idx = column_names.index(column1)
-                        comp_operand1_value = value[idx]
-                        comp_operand1_type = column_types[idx].lower()
-
-            if comp_operand2.children[0] != None and comp_operand2.children[0].data == 'comparable_value':
-                comp_operand2_value = comp_operand2.children[0].children[0]
-                comp_operand2_type = comp_operand2.children[0].children[0].type.lower()
-            else: # When operand is column
-                column2 = comp_operand2.children[1].children[0]
-                if comp_operand2.children[0]:
-                    table2 = comp_operand2.children[0].children[0]
-                else:
-                    table2 = ''
-                if table2:
-                    if column2 not in column_names:
-                        print(f"{prompt_msg}Where clause trying to reference non existing column") # WhereColumnNotExist
-                        raise
-                    elif (table2, column2) not in table_column_names:
-                        print(f"{prompt_msg}Where clause trying to reference tables which are not specified") # WhereTableNotSpecified
-                        raise
-                    else:
-                        idx = table_column_names.index((table2, column2))
-                        comp_operand2_value = value[idx]
-                        comp_operand2_type = column_types[idx].lower()
-                else:
-                    if column2 not in column_names:
-                        print(f"{prompt_msg}Where clause trying to reference non existing column") # WhereColumnNotExist
-                        raise
-                    elif column_names.count(column2) > 1:
-                        print(f"{prompt_msg}Where clause contains ambiguous reference") # WhereAmbiguousReference
-                        raise
-                    else:
-                        idx = column_names.index(column2)
-                        comp_operand2_value = value[idx]
-                        comp_operand2_type = column_types[idx].lower()
-
-            type_error = False
-            if comp_operand1_type == comp_operand2_type:
-                pass
-            elif 'char' in comp_operand1_type and 'char' in comp_operand2_type:
-                pass
-            elif 'char' in comp_operand1_type and comp_operand2_type == 'str':
-                pass
-            elif comp_operand1_type == 'str' and 'char' in comp_operand2_type:
-                pass
-            else:
-                type_error = True;
-            
-            if type_error:
-                print(f"{prompt_msg}Where clause trying to compare incomparable values") # WhereIncomparableError
-                raise
-
-            comp_op_iter = tree.children[1].children[0].children[0].find_data('comp_op')
-            comp_op = next(comp_op_iter).children[0]
-
-            if comp_op == '>':
-                result = True if comp_operand1_value > comp_operand2_value else False
-            elif comp_op == '<':
-                result = True if comp_operand1_value < comp_operand2_value else False
-            elif comp_op == '=':
-                result = True if comp_operand1_value == comp_operand2_value else False
-            elif comp_op == '!=':
-                result = True if comp_operand1_value != comp_operand2_value else False
-            elif comp_op == '>=':
-                result = True if comp_operand1_value >= comp_operand2_value else False
-            elif comp_op == '<=':
-                result = True if comp_operand1_value <= comp_operand2_value else False
-
-            if is_not:
-                return not result
-            else:
-                return result
-            
-        else: # When predicate is null_predicate
-            column = tree.children[1].children[0].children[0].children[1].children[0]
-            if tree.children[1].children[0].children[0].children[0]:
-                table = tree.children[1].children[0].children[0].children[0].children[0]
-            else:
-                table = ''
-            if table:
-                if column not in column_names:
-                    print(f"{prompt_msg}Where clause trying to reference non existing column") # WhereColumnNotExist
-                    raise
-                elif (table, column) not in table_column_names:
-                    print(f"{prompt_msg}Where clause trying to reference tables which are not specified") # WhereTableNotSpecified
-                    raise
-                else:
-                    idx = table_column_names.index((table, column))
-                    column_value = value[idx].lower()
+
+def row_size(row):
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+def table_size(table_name):
+    # Size of table file is used as an estimate of the number of rows
+    table_path = 'DB/'+table_name+'.db'
+    return os.path.getsize(table_path) if os.path.exists(table_path) else 0
+
+
+def plan_join_rows(session, schemas, column_names, column_types, table_column_names, where_expr, used_columns):
+    # Join tables using equality conjuncts between the joined tables and the next table as hash join keys.
+    # Conjuncts on a single table are filtered during its scan, which reads through primary key or
+    # secondary index when conjuncts allow it. The remaining conjuncts are filtered after the joins.
+    # Tables are joined in from clause order, or in the order of least estimated cost when all of them
+    # are analyzed. Return callable building the pipeline, so that the plan can be executed again
+    table_names = [schema.table_name for schema in schemas]
+    pool = session.pool
+    column_tables = [table_names.index(table) for table, _ in table_column_names]
+    offsets = [column_tables.index(i) for i in range(len(table_names))] + [len(column_names)]
+
+    # Equality conjuncts between two tables are (column index, column index) ordered by from clause
+    join_edges, pushed_down, residual = [], {}, []
+    for conjunct in split_conjuncts(where_expr) if where_expr else []:
+        # Compiling reports Where* errors of every conjunct, also of those becoming hash join keys
+        predicate = compile_bool_factor(conjunct, column_names, column_types, table_column_names)
+        equi_join = find_equi_join(conjunct, column_names, column_types, table_column_names)
+        tables = {column_tables[idx] for idx in find_where_columns(conjunct, column_names, table_column_names)}
+        if equi_join and column_tables[equi_join[0]] != column_tables[equi_join[1]]:
+            join_edges.append(tuple(sorted(equi_join, key=lambda idx: column_tables[idx])))
+        elif len(tables) <= 1:
+            table = tables.pop() if tables else 0
+            pushed_down.setdefault(table, []).append(conjunct)
+        else:
+            residual.append((conjunct, predicate))
+
+    def table_rows(table):
+        # Return (callable yielding rows of the table, estimated rows read, estimated rows returned, plan node).
+        # Estimates of a table which is not analyzed are the size of its file
+        start, end = offsets[table], offsets[table + 1]
+        schema = schemas[table]
+        decode_indices = None if used_columns is None else {idx - start for idx in used_columns if start <= idx < end}
+        decode = schema.codec.decoder(decode_indices)
+        conjuncts = pushed_down.get(table, [])
+        local_columns = column_names[start:end], column_types[start:end], table_column_names[start:end]
+        if schema.statistics:
+            returned = schema.statistics.row_count
+            for conjunct in conjuncts:
+                returned *= estimate_selectivity(conjunct, schema.statistics, *local_columns)
+            read = schema.statistics.row_count
+        else:
+            returned = read = table_size(table_names[table])
+
+        # Compile again against columns of the table alone, so that it can run on scanned rows
+        predicate = compile_conjuncts(conjuncts, schema)
+        if conjuncts:
+            access_path = plan_access_path(session, table_names[table], schema.primary_key_indices, schema.indexes, conjuncts, *local_columns, decode, schema.statistics)
+            if access_path:
+                node = scan_node(schema, access_path, conjuncts, returned if schema.statistics else None)
+                return lambda: filter_rows((value for _, value in node.read(access_path(), access_path.access[1])), predicate), returned, returned, node
+        batch_filter, other_conjuncts = compile_batch_filter(conjuncts, schema)
+        other_predicate = compile_conjuncts(other_conjuncts, schema)
+        node = scan_node(schema, None, conjuncts, returned if schema.statistics else None)
+        if batch_filter:
+            node.note = "batch filter"
+
+        def scan():
+            # Large tables are decoded and filtered by scan workers when the statement allows it
+            if parallel_scan_allowed(session, table_names[table]):
+                node.note = f"{scan_parallelism} workers"
+                return parallel_scan(session, schema, decode_indices, conjuncts, False)
+            node.note = "batch filter" if batch_filter else None
+            items = node.read(table_items(pool.table(table_names[table]), session.txn))
+            if batch_filter:
+                return batch_filter_rows(items, batch_filter, decode, other_predicate, False)
+            rows = (decode(data) for _, data in items)
+            return filter_rows(rows, predicate) if predicate else rows
+        return scan, read, returned, node
+
+    inputs, reads, estimates, nodes = zip(*[table_rows(i) for i in range(len(table_names))])
+    analyzed = all(schema.statistics for schema in schemas)
+    def edge_distinct(idx):
+        table = column_tables[idx]
+        return schemas[table].statistics.distinct(idx - offsets[table])
+    edges = [(column_tables[left_idx], column_tables[right_idx], max(edge_distinct(left_idx), edge_distinct(right_idx)) if analyzed else 1)
+             for left_idx, right_idx in join_edges]
+    order = list(range(len(table_names)))
+    if analyzed and 1 < len(table_names) <= join_order_search_limit:
+        order = choose_join_order(reads, estimates, edges)
+
+    # Each join is (table rows, hash join keys or None, whether left input is the build side, table node, join node).
+    # Column index of the from clause layout is mapped to its position in joined rows
+    position, joined, joins = {}, set(), []
+    def place(table):
+        for idx in range(offsets[table], offsets[table + 1]):
+            position[idx] = len(position)
+        joined.add(table)
+    place(order[0])
+    estimate, node = estimates[order[0]], nodes[order[0]]
+    for table in order[1:]:
+        keys = [(left_idx, right_idx) if column_tables[right_idx] == table else (right_idx, left_idx)
+                for left_idx, right_idx in join_edges
+                if {column_tables[left_idx], column_tables[right_idx]} - joined == {table}]
+        if keys:
+            left_key = [position[left_idx] for left_idx, _ in keys]
+            right_key = [right_idx - offsets[table] for _, right_idx in keys]
+            joins.append((inputs[table], (left_key, right_key), estimate < estimates[table], nodes[table]))
+            condition = ' and '.join(f"{'.'.join(table_column_names[left_idx])} = {'.'.join(table_column_names[right_idx])}" for left_idx, right_idx in keys)
+            title, detail = "Hash Join", f"{condition}, build {'left' if estimate < estimates[table] else 'right'}"
+        else:
+            joins.append((inputs[table], None, False, nodes[table]))
+            title, detail = "Nested Loop", None
+        if analyzed:
+            estimate = join_estimate(estimate, estimates[table], [distinct for left, right, distinct in edges if {left, right} - joined == {table}])
+        elif keys:
+            estimate = max(estimate, estimates[table])
+        else:
+            estimate *= max(estimates[table], 1)
+        node = PlanNode(title, detail, estimate if analyzed else None, [node, nodes[table]])
+        joins[-1] += (node,)
+        place(table)
+    permutation = [position[idx] for idx in range(len(column_names))] if order != sorted(order) else None
+    residual_predicate = None
+    if residual:
+        residual_predicate = all_predicate([predicate for _, predicate in residual])
+        node = PlanNode("Filter", ' and '.join(condition_text(conjunct) for conjunct, _ in residual), None, [node])
+    top_node = node
+
+    def rows():
+        rows = nodes[order[0]].output(inputs[order[0]]())
+        for table_rows, keys, build_left, table_node, join_node in joins:
+            if keys:
+                rows = hash_join_rows(rows, table_node.output(table_rows()), keys[0], keys[1], build_left)
             else:
-                if column not in column_names:
-                    print(f"{prompt_msg}Where clause trying to reference non existing column") # WhereColumnNotExist
-                    raise
-                elif column_names.count(column) > 1:
-                    print(f"{prompt_msg}Where clause contains ambiguous reference") # WhereAmbiguousReference
-                    raise
+                rows = nested_loop_rows(rows, lambda table_rows=table_rows, table_node=table_node: table_node.output(table_rows()))
+            rows = join_node.output(rows)
+        if permutation:
+            rows = project_rows(rows, permutation)
+        if residual_predicate:
+            rows = top_node.output(filter_rows(rows, residual_predicate))
+        return rows
+    return rows, top_node
+
+
+def join_estimate(left_rows, right_rows, distincts):
+    # Estimated rows of a join, each equality key divides the product by the larger number of distinct values
+    estimate = left_rows * right_rows
+    for distinct in distincts:
+        estimate /= distinct
+    return estimate
+
+
+def choose_join_order(reads, estimates, edges):
+    # Return left-deep join order of least estimated cost, searched over subsets of tables.
+    # reads and estimates are rows read and returned by each table, edges are (table, table, distinct values).
+    # Hash join reads the next table once, nested loop reads it again for every joined row
+    best = {frozenset([table]): (reads[table], estimates[table], [table]) for table in range(len(reads))}
+    for size in range(2, len(reads) + 1):
+        for tables in combinations(range(len(reads)), size):
+            tables = frozenset(tables)
+            for table in sorted(tables):
+                cost, rows, order = best[tables - {table}]
+                distincts = [distinct for left, right, distinct in edges if table in (left, right) and {left, right} <= tables]
+                joined_rows = join_estimate(rows, estimates[table], distincts)
+                if distincts:
+                    cost += reads[table] + rows + joined_rows
                 else:
-                    idx = column_names.index(column)
-                    column_value = value[idx].lower()
-
-            is_not_null = tree.children[1].children[0].children[0].children[2].children[1]
-            if is_not_null:
-                return not column_value == 'null'
-            else: # is null
-                return column_value == 'null'
-            
+                    cost += rows * reads[table] + joined_rows
+                if tables not in best or cost < best[tables][0]:
+                    best[tables] = (cost, joined_rows, order + [table])
+    return best[frozenset(range(len(reads)))][2]
+
+
+class PlanNode:
+    # Operator of a plan shown by EXPLAIN, with estimated rows when tables are analyzed. Records passing
+    # through read() are always counted, for statement statistics. Once instrumented by EXPLAIN ANALYZE,
+    # rows passing through output() are counted and timed as well.
+    # files are the table and index files the operator reads, for pages requested from the buffer pool
+    def __init__(self, title, detail=None, estimate=None, children=(), files=()):
+        self.title, self.detail, self.estimate = title, detail, estimate
+        self.children, self.files = list(children), list(files)
+        self.note, self.instrumented, self.calls_per_item = None, False, None
+        self.reset()
+
+    def reset(self):
+        self.rows, self.scanned, self.seconds, self.pages, self.ran = 0, 0, 0.0, None, False
+
+    def output(self, rows):
+        if not self.instrumented:
+            return rows
+        self.ran = True
+        return self.count_rows(rows)
+
+    def count_rows(self, rows):
+        # Time includes the operators below, as rows are pulled through them
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            row = next(rows, None)
+            self.seconds += time.perf_counter() - start
+            if row is None:
+                return
+            self.rows += 1
+            yield row
+
+    def read(self, items, calls_per_item=1):
+        # One cursor call reads each scanned record, index scans also look the row up in the table
+        self.calls_per_item = calls_per_item
+        return self.count_reads(items)
+
+    def count_reads(self, items):
+        for item in items:
+            self.scanned += 1
+            yield item
+
+    def nodes(self):
+        yield self
+        for child in self.children:
+            yield from child.nodes()
+
+    def total_scanned(self):
+        return sum(node.scanned for node in self.nodes())
+
+    def lines(self, analyze, depth=0):
+        line = ("  " * (depth - 1) + "-> " if depth else "") + self.title
+        if self.detail:
+            line += f" ({self.detail})"
+        if self.note:
+            line += f" [{self.note}]"
+        if self.estimate is not None:
+            line += f"  estimated rows={round(self.estimate)}"
+        if analyze and not self.ran:
+            line += "  (never executed)"
+        elif analyze:
+            line += f"  actual rows={self.rows} time={self.seconds * 1000:.3f} ms"
+            if self.calls_per_item is not None:
+                line += f" cursor calls={self.scanned * self.calls_per_item}"
+            if self.pages is not None:
+                line += f" pages={self.pages}"
+        yield line
+        for child in self.children:
+            yield from child.lines(analyze, depth + 1)
+
+
+def scan_node(schema, access_path, conjuncts, estimate):
+    # Plan node reading one table through the access path, or scanning it when access path is None
+    detail = ' and '.join(condition_text(conjunct) for conjunct in conjuncts) or None
+    if access_path is None:
+        return PlanNode(f"Seq Scan on {schema.table_name}", detail, estimate, files=[schema.table_name+'.db'])
+    label, _, index_name = access_path.access
+    files = [schema.table_name+'.db']
+    if index_name:
+        files.append(os.path.relpath(secondary_index_path(schema.table_name, index_name), 'DB'))
+    return PlanNode(f"{label} on {schema.table_name}", detail, estimate, files=files)
+
+
+def table_files(schema):
+    # Files written when rows of the table change
+    return [schema.table_name+'.db'] + [os.path.relpath(secondary_index_path(schema.table_name, index_name), 'DB') for index_name, _ in schema.indexes]
+
+
+def condition_text(tree):
+    # Text of a where clause tree, as EXPLAIN shows it
+    if isinstance(tree, Token):
+        return str(tree.value)
+    parts = [condition_text(child) for child in tree.children if child is not None]
+    if tree.data in ('comp_operand', 'null_predicate') and isinstance(tree.children[0], Tree) and tree.children[0].data == 'table_name':
+        parts[:2] = [parts[0] + '.' + parts[1]]
+    return ' '.join(parts).replace('( ', '(').replace(' )', ')')
+
+
+def file_page_requests(dbEnv):
+    # Pages of each file requested from the buffer pool so far, found there or read from disk
+    return {file: stat['cache_hit'] + stat['cache_miss'] for file, stat in dbEnv.memp_stat()[1].items()}
+
+
+def limit_operand(limit_value):
+    # LIMIT and OFFSET take an int literal, or a parameter which is bound to an int
+    token = limit_value.children[0]
+    if token.type == 'PARAM':
+        token.value.literal_type = 'int'
+        return token.value
+    return int(token)
+
+
+def limit_rows(rows, limit, offset):
+    if value_literal_type(limit) != 'int' or value_literal_type(offset) != 'int' or limit < 0 or offset < 0:
+        raise DataError("Selection has failed: LIMIT and OFFSET have to be non-negative") # SelectLimitError
+    return sliced_rows(rows, offset, offset + limit)
+
+
+def sliced_rows(rows, start, stop):
+    # Rows are closed once the last row is taken, which closes the cursors reading them
+    try:
+        yield from islice(rows, start, stop)
+    finally:
+        end_rows(rows, None)
+
+
+def all_predicate(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda value: all(predicate(value) for predicate in predicates)
+
+
+def filter_rows(rows, predicate):
+    for row in rows:
+        if predicate(row):
+            yield row
+
+
+def project_rows(rows, indices):
+    for row in rows:
+        yield [row[idx] for idx in indices]
+
+
+def print_description(table_name, rows, headers, file):
+    print("-----------------------------------------------------------------", file=file)
+    print(f"table_name [{table_name}]", file=file)
+    print("{:20} {:15} {:10} {:10}".format(*headers), file=file)
+    for row in rows:
+        print("{:20} {:15} {:10} {:10}".format(*row), file=file)
+    print("-----------------------------------------------------------------", file=file)
+
+
+def print_plan(rows, headers, file):
+    print("-----------------------------------------------------------------", file=file)
+    for line, in rows:
+        print(line, file=file)
+    print("-----------------------------------------------------------------", file=file)
+
+
+def print_stats(rows, headers, file):
+    # Statement kind is wider than the numbers following it
+    line = '-' * (22 + 14 * (len(headers) - 1))
+    row_format = "{:<22}" + "{:>14}" * (len(headers) - 1)
+    print(line, file=file)
+    print(row_format.format(*headers), file=file)
+    print(line, file=file)
+    for row in rows:
+        print(row_format.format(*map(format_value, row)), file=file)
+    print(line, file=file)
+
+
+def print_table_names(rows, headers, file):
+    print("-----------------------------------------------------------------", file=file)
+    for table_name, in rows:
+        print(table_name, file=file)
+    print("-----------------------------------------------------------------", file=file)
+
+
+def print_rows(rows, headers, file):
+    # Header is written only when the first row arrives, closing line is always written.
+    # Rows are formatted a chunk at a time and written with one call
+    line = '-' * 20 * len(headers)
+    row_format = "{:<20} " * len(headers) + '\n'
+    is_first = True
+    for chunk in row_chunks(rows):
+        if is_first:
+            file.write(f"{line}\n{row_format.format(*headers)}{line}\n")
+            is_first = False
+        file.write(''.join([row_format.format(*map(format_value, row)) for row in chunk]))
+    file.write(line + '\n')
+
+
+def row_chunks(rows):
+    # Cursor hands over a chunk of rows at a time, other iterables are cut into chunks
+    if hasattr(rows, 'fetchmany'):
+        return iter(lambda: rows.fetchmany(output_chunk_rows), [])
+    rows = iter(rows)
+    return iter(lambda: list(islice(rows, output_chunk_rows)), [])
+
+
+def write_table(rows, headers, printer, file):
+    # Rows in the layout of the statement, which the REPL shows by default
+    printer(rows, headers, file)
+
+
+def write_csv(rows, headers, printer, file):
+    # Header line and a line for each row, null is an empty field
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for chunk in row_chunks(rows):
+        writer.writerows(chunk)
+        file.write(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+    file.write(buffer.getvalue())
+
+
+def write_json_lines(rows, headers, printer, file):
+    # Same objects as the server sends, {"columns": [...]} and then {"row": [...]} for each row
+    file.write(json.dumps({'columns': headers}) + '\n')
+    for chunk in row_chunks(rows):
+        file.write(''.join([json.dumps({'row': row}, default=str) + '\n' for row in chunk]))
+
+
+def discard_rows(rows, headers, printer, file):
+    # Rows are read and dropped, for timing statements without the cost of output
+    for _ in row_chunks(rows):
+        pass
+
+
+# Ways of writing rows returned by statements, chosen by --format of the REPL
+output_sinks = {'table': write_table, 'csv': write_csv, 'jsonl': write_json_lines, 'discard': discard_rows}
+
+
+comp_ops = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def format_value(value):
+    return 'null' if value is None else str(value)
+
+
+def compile_bool_expr(tree, column_names, column_types, table_column_names):
+    # Compile boolean_expr once into a short-circuiting callable over a row
+    # Odd children are 'or', so just compile even children
+    terms = [compile_bool_term(child, column_names, column_types, table_column_names) for child in tree.children[::2]]
+    if len(terms) == 1:
+        return terms[0]
+    return lambda value: any(term(value) for term in terms)
+
+
+def compile_bool_term(tree, column_names, column_types, table_column_names):
+    # Odd children are 'and', so just compile even children
+    factors = [compile_bool_factor(child, column_names, column_types, table_column_names) for child in tree.children[::2]]
+    if len(factors) == 1:
+        return factors[0]
+    return lambda value: all(factor(value) for factor in factors)
+
+
+def compile_bool_factor(tree, column_names, column_types, table_column_names):
+    is_not = True if tree.children[0] else False
+    boolean_test = tree.children[1].children[0]
+    if boolean_test.data == 'predicate':
+        predicate = boolean_test.children[0]
+        if predicate.data == 'comparison_predicate':
+            result = compile_comparison_predicate(predicate, column_names, column_types, table_column_names)
+        else: # When predicate is null_predicate
+            result = compile_null_predicate(predicate, column_names, column_types, table_column_names)
     else: # When parenthesized_boolean_expr
-        if is_not:
-            return not evaluate_bool_expr(tree.children[1].children[0].children[1])
+        result = compile_bool_expr(boolean_test.children[1], column_names, column_types, table_column_names)
+
+    if is_not:
+        return lambda value: not result(value)
+    return result
+
+
+def split_conjuncts(tree):
+    # Return boolean_factors which are AND-ed at the top level of boolean_expr
+    if len(tree.children) > 1:
+        return [parenthesize(tree)]
+    conjuncts = []
+    for factor in tree.children[0].children[::2]:
+        boolean_test = factor.children[1].children[0]
+        if not factor.children[0] and boolean_test.data == 'parenthesized_boolean_expr':
+            conjuncts.extend(split_conjuncts(boolean_test.children[1]))
+        else:
+            conjuncts.append(factor)
+    return conjuncts
+
+
+def parenthesize(tree):
+    # Wrap boolean_expr into boolean_factor so that it can be treated as a conjunct
+    boolean_test = Tree('boolean_test', [Tree('parenthesized_boolean_expr', [Token('LP', '('), tree, Token('RP', ')')])])
+    return Tree('boolean_factor', [None, boolean_test])
+
+
+def find_equality_operands(tree, column_names, column_types, table_column_names):
+    # Return both compiled operands when boolean_factor is a plain '=' comparison
+    if tree.children[0] or tree.children[1].children[0].data != 'predicate':
+        return None
+    predicate = tree.children[1].children[0].children[0]
+    if predicate.data != 'comparison_predicate' or predicate.children[1].children[0] != '=':
+        return None
+    operand1 = compile_comp_operand(predicate.children[0], column_names, column_types, table_column_names)
+    operand2 = compile_comp_operand(predicate.children[2], column_names, column_types, table_column_names)
+    return operand1, operand2
+
+
+def find_equi_join(tree, column_names, column_types, table_column_names):
+    # Return indices of both columns when boolean_factor is 'column = column'
+    operands = find_equality_operands(tree, column_names, column_types, table_column_names)
+    if operands and operands[0][0] and operands[1][0]:
+        return operands[0][1], operands[1][1]
+    return None
+
+
+def find_equal_values(conjuncts, column_names, column_types, table_column_names):
+    # Return dict from column index to literal for conjuncts of the form 'column = literal'
+    equal_values = {}
+    for conjunct in conjuncts:
+        operands = find_equality_operands(conjunct, column_names, column_types, table_column_names)
+        if not operands:
+            continue
+        (is_column1, operand1, _), (is_column2, operand2, _) = operands
+        if is_column1 and not is_column2:
+            equal_values[operand1] = operand2
+        elif is_column2 and not is_column1:
+            equal_values[operand2] = operand1
+    return equal_values
+
+
+def find_range_values(conjuncts, column_names, column_types, table_column_names):
+    # Return dict from column index to list of (op, literal) for conjuncts of the form 'column op literal'
+    flipped_ops = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+    range_values = {}
+    for conjunct in conjuncts:
+        if conjunct.children[0] or conjunct.children[1].children[0].data != 'predicate':
+            continue
+        predicate = conjunct.children[1].children[0].children[0]
+        if predicate.data != 'comparison_predicate' or predicate.children[1].children[0] not in flipped_ops:
+            continue
+        op = str(predicate.children[1].children[0])
+        is_column1, operand1, _ = compile_comp_operand(predicate.children[0], column_names, column_types, table_column_names)
+        is_column2, operand2, _ = compile_comp_operand(predicate.children[2], column_names, column_types, table_column_names)
+        if is_column1 and not is_column2:
+            range_values.setdefault(operand1, []).append((op, operand2))
+        elif is_column2 and not is_column1:
+            range_values.setdefault(operand2, []).append((flipped_ops[op], operand1))
+    return range_values
+
+
+def find_where_columns(tree, column_names, table_column_names):
+    # Return indices of all columns referenced in the subtree
+    indices = []
+    for comp_operand in tree.find_data('comp_operand'):
+        if comp_operand.children[0] == None or comp_operand.children[0].data != 'comparable_value':
+            indices.append(resolve_where_column(comp_operand.children[0], comp_operand.children[1], column_names, table_column_names))
+    for null_predicate in tree.find_data('null_predicate'):
+        indices.append(resolve_where_column(null_predicate.children[0], null_predicate.children[1], column_names, table_column_names))
+    return indices
+
+
+def resolve_where_column(table_name, column_name, column_names, table_column_names):
+    # Return index of the referenced column in a row
+    column = column_name.children[0].lower()
+    table = table_name.children[0].lower() if table_name else ''
+    if column not in column_names:
+        raise ProgrammingError("Where clause trying to reference non existing column") # WhereColumnNotExist
+    if table:
+        if (table, column) not in table_column_names:
+            raise ProgrammingError("Where clause trying to reference tables which are not specified") # WhereTableNotSpecified
+        return table_column_names.index((table, column))
+    if column_names.count(column) > 1:
+        raise ProgrammingError("Where clause contains ambiguous reference") # WhereAmbiguousReference
+    return column_names.index(column)
+
+
+def compile_comp_operand(comp_operand, column_names, column_types, table_column_names):
+    # Return (is_column, index or constant value or parameter, comparable type)
+    if comp_operand.children[0] != None and comp_operand.children[0].data == 'comparable_value':
+        token = comp_operand.children[0].children[0]
+        if token.type == 'PARAM':
+            return False, token.value, 'param'
+        if token.type == 'INT':
+            value = int(token)
+        elif token.type == 'DATE':
+            try:
+                value = date.fromisoformat(token)
+            except ValueError:
+                raise ProgrammingError("Where clause trying to compare incomparable values") # WhereIncomparableError
+        else:
+            value = token[1:-1]
+        return False, value, token.type.lower()
+    idx = resolve_where_column(comp_operand.children[0], comp_operand.children[1], column_names, table_column_names)
+    column_type = column_types[idx].lower()
+    if 'char' in column_type:
+        column_type = 'str'
+    return True, idx, column_type
+
+
+def compile_comparison_predicate(tree, column_names, column_types, table_column_names):
+    is_column1, operand1, type1 = compile_comp_operand(tree.children[0], column_names, column_types, table_column_names)
+    is_column2, operand2, type2 = compile_comp_operand(tree.children[2], column_names, column_types, table_column_names)
+    if type1 == 'param' and type2 != 'param':
+        operand1.literal_type = type1 = type2
+    elif type2 == 'param' and type1 != 'param':
+        operand2.literal_type = type2 = type1
+    if type1 != type2 or type1 == 'param':
+        raise ProgrammingError("Where clause trying to compare incomparable values") # WhereIncomparableError
+
+    # Comparison with null is never true, parameters are read when the predicate runs
+    op = comp_ops[tree.children[1].children[0]]
+    if isinstance(operand1, Parameter) or isinstance(operand2, Parameter):
+        if is_column1:
+            return lambda value: value[operand1] is not None and operand2.value is not None and op(value[operand1], operand2.value)
+        elif is_column2:
+            return lambda value: value[operand2] is not None and operand1.value is not None and op(operand1.value, value[operand2])
+        return lambda value: bound_value(operand1) is not None and bound_value(operand2) is not None and op(bound_value(operand1), bound_value(operand2))
+    if is_column1 and is_column2:
+        return lambda value: value[operand1] is not None and value[operand2] is not None and op(value[operand1], value[operand2])
+    elif is_column1:
+        return lambda value: value[operand1] is not None and op(value[operand1], operand2)
+    elif is_column2:
+        return lambda value: value[operand2] is not None and op(operand1, value[operand2])
+    result = op(operand1, operand2)
+    return lambda value: result
+
+
+def compile_null_predicate(tree, column_names, column_types, table_column_names):
+    idx = resolve_where_column(tree.children[0], tree.children[1], column_names, table_column_names)
+    is_not_null = tree.children[2].children[1]
+    if is_not_null:
+        return lambda value: value[idx] is not None
+    else: # is null
+        return lambda value: value[idx] is None
+
+
+def estimate_selectivity(tree, statistics, column_names, column_types, table_column_names):
+    # Estimated fraction of rows of an analyzed table satisfying boolean_expr, boolean_term or boolean_factor
+    if tree.data == 'boolean_expr':
+        fraction = 1.0
+        for term in tree.children[::2]:
+            fraction *= 1 - estimate_selectivity(term, statistics, column_names, column_types, table_column_names)
+        return 1 - fraction
+    if tree.data == 'boolean_term':
+        fraction = 1.0
+        for factor in tree.children[::2]:
+            fraction *= estimate_selectivity(factor, statistics, column_names, column_types, table_column_names)
+        return fraction
+
+    boolean_test = tree.children[1].children[0]
+    if boolean_test.data == 'parenthesized_boolean_expr':
+        fraction = estimate_selectivity(boolean_test.children[1], statistics, column_names, column_types, table_column_names)
+    elif boolean_test.children[0].data == 'null_predicate':
+        predicate = boolean_test.children[0]
+        idx = resolve_where_column(predicate.children[0], predicate.children[1], column_names, table_column_names)
+        fraction = statistics.null_fraction(idx)
+        if predicate.children[2].children[1]:
+            fraction = 1 - fraction
+    else:
+        predicate = boolean_test.children[0]
+        is_column1, operand1, _ = compile_comp_operand(predicate.children[0], column_names, column_types, table_column_names)
+        is_column2, operand2, _ = compile_comp_operand(predicate.children[2], column_names, column_types, table_column_names)
+        op = predicate.children[1].children[0]
+        if is_column1 and not is_column2:
+            fraction = statistics.selectivity(operand1, op, None if isinstance(operand2, Parameter) else operand2)
+        elif is_column2 and not is_column1:
+            flipped = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}.get(op, op)
+            fraction = statistics.selectivity(operand2, flipped, None if isinstance(operand1, Parameter) else operand1)
+        else:
+            fraction = 1 / 3
+    return 1 - fraction if tree.children[0] else fraction
+
+
+def compile_conjuncts(conjuncts, schema):
+    # Compile conjuncts on columns of a single table, None when there are none
+    if not conjuncts:
+        return None
+    table_column_names = [(schema.table_name, column_name) for column_name in schema.column_names]
+    return all_predicate([compile_bool_factor(conjunct, schema.column_names, schema.column_types, table_column_names) for conjunct in conjuncts])
+
+
+flipped_ops = {operator.lt: operator.gt, operator.le: operator.ge, operator.eq: operator.eq,
+               operator.ne: operator.ne, operator.gt: operator.lt, operator.ge: operator.le}
+
+
+def compile_batch_filter(conjuncts, schema):
+    # Split conjuncts on columns of a single table into the ones NumPy evaluates on int and date slots
+    # of encoded rows and the others. Return (callable from list of encoded rows to boolean mask, or None
+    # when no conjunct qualifies, other conjuncts)
+    if numpy is None or not scan_batch_size:
+        return None, conjuncts
+    codec = schema.codec
+    tests, others = [], []
+    for conjunct in conjuncts:
+        test = compile_batch_test(conjunct, schema)
+        if test:
+            tests.append(test)
+        else:
+            others.append(conjunct)
+    if not tests:
+        return None, conjuncts
+
+    # Null bitmap and fixed width slots at the start of each row are read as one record array
+    fields = {'names': ['bitmap'], 'formats': [(numpy.uint8, codec.bitmap_size)], 'offsets': [0], 'itemsize': codec.fixed_size}
+    for idx, offset, _, is_date in codec.fixed_columns:
+        fields['names'].append(f'c{idx}')
+        fields['formats'].append('>i4' if is_date else '>i8')
+        fields['offsets'].append(offset)
+    slots_type, fixed_size = numpy.dtype(fields), codec.fixed_size
+
+    def batch_filter(rows):
+        slots = numpy.frombuffer(b''.join([row[:fixed_size] for row in rows]), slots_type)
+        mask = numpy.ones(len(rows), dtype=bool)
+        for test in tests:
+            mask &= test(slots)
+        return mask
+    return batch_filter, others
+
+
+def compile_batch_test(conjunct, schema):
+    # Return callable from slots to boolean mask of a conjunct comparing an int or date column with a constant
+    # or parameter, or testing a column for null. None for other conjuncts. Comparison with null is never true
+    table_column_names = [(schema.table_name, column_name) for column_name in schema.column_names]
+    boolean_test = conjunct.children[1].children[0]
+    if boolean_test.data != 'predicate':
+        return None
+    predicate = boolean_test.children[0]
+    if predicate.data == 'null_predicate':
+        idx = resolve_where_column(predicate.children[0], predicate.children[1], schema.column_names, table_column_names)
+        byte, bit = divmod(idx, 8)
+        is_null = not predicate.children[2].children[1]
+        test = lambda slots: (slots['bitmap'][:, byte] >> bit & 1 == 1) == is_null
+    else:
+        is_column1, operand1, type1 = compile_comp_operand(predicate.children[0], schema.column_names, schema.column_types, table_column_names)
+        is_column2, operand2, type2 = compile_comp_operand(predicate.children[2], schema.column_names, schema.column_types, table_column_names)
+        op = comp_ops[predicate.children[1].children[0]]
+        if is_column1 and not is_column2:
+            idx, operand, column_type = operand1, operand2, type1
+        elif is_column2 and not is_column1:
+            idx, operand, column_type, op = operand2, operand1, type2, flipped_ops[op]
         else:
-            return evaluate_bool_expr(tree.children[1].children[0].children[1])
+            return None
+        if column_type not in ('int', 'date') or (isinstance(operand, int) and not -(1 << 63) <= operand < (1 << 63)):
+            return None
+        byte, bit, field = idx // 8, idx % 8, f'c{idx}'
+
+        def test(slots):
+            value = bound_value(operand)
+            if value is None:
+                return numpy.zeros(len(slots), dtype=bool)
+            if column_type == 'date':
+                value = value.toordinal()
+            return (slots['bitmap'][:, byte] >> bit & 1 == 0) & op(slots[field], value)
+    if conjunct.children[0]:
+        return lambda slots: ~test(slots)
+    return test
+
+
+def batch_filter_rows(items, batch_filter, decode, predicate, with_keys):
+    # Evaluate batch filter on (key, encoded row) items a batch at a time, decode only the rows it selects
+    # and yield the ones passing predicate, as (row key, column values) when with_keys
+    for batch in batched(items, scan_batch_size):
+        for i in numpy.flatnonzero(batch_filter([data for _, data in batch])):
+            key, data = batch[i]
+            value = decode(data)
+            if predicate is None or predicate(value):
+                yield (key, value) if with_keys else value
+
+
+class Result:
+    # Outcome of a statement: messages for the client, number of rows it changed, and for statements
+    # returning rows their column names and the iterator of rows. printer shows rows the way the REPL does
+    def __init__(self, messages=(), rowcount=-1, columns=None, rows=None, printer=print_rows):
+        self.messages, self.rowcount = list(messages), rowcount
+        self.columns, self.rows, self.printer = columns, rows, printer
+        self.exhausted, self.discarded, self.finalizer = False, False, None
+
+    def hold(self, txn):
+        # Snapshot the rows are read in ends with the rows, also when the result is collected unread
+        self.finalizer = weakref.finalize(self, end_rows, self.rows, txn)
+
+    def finish(self):
+        if self.finalizer:
+            self.finalizer()
+        else:
+            end_rows(self.rows, None)
 
-    
-# run.py starts from this location
-with open('grammar.lark') as file:
-    sql_parser = Lark(file.read(), start="command", lexer="basic")
-before_query = ""
-while True:
+    def discard(self):
+        self.finish()
+        self.discarded = True
+
+    def is_open(self):
+        return self.rows is not None and not self.exhausted and not self.discarded
+
+
+def end_rows(rows, txn):
+    if hasattr(rows, 'close'):
+        rows.close()
+    if txn:
+        txn.commit()
+
+
+class Connection:
+    # Client of the database in DB directory. Each statement commits on its own unless BEGIN is executed,
+    # then commit and rollback end the transaction
+    def __init__(self):
+        self.session = Session(acquire_database())
+        self.is_closed = False
+
+    def cursor(self):
+        self.check_open()
+        return Cursor(self)
+
+    def execute(self, text, parameters=None):
+        return self.cursor().execute(text, parameters)
+
+    def prepare(self, text):
+        # Parse, validate and plan the statement once, the returned statement is given to Cursor.execute
+        self.check_open()
+        return self.session.prepare(text)
+
+    def commit(self):
+        self.check_open()
+        if self.session.txn:
+            self.session.commit()
+
+    def rollback(self):
+        self.check_open()
+        if self.session.txn:
+            self.session.rollback()
+
+    def close(self):
+        # Transaction which is not committed is rolled back
+        if self.is_closed:
+            return
+        self.session.close()
+        self.is_closed = True
+        release_database()
+
+    def check_open(self):
+        if self.is_closed:
+            raise InterfaceError("Connection is closed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Cursor:
+    # Runs statements of a connection. Rows are tuples of int, str, datetime.date or None, which are
+    # read from the tables while the cursor is iterated. Rows not read before the connection writes
+    # or ends the transaction are discarded
+    def __init__(self, connection):
+        self.connection = connection
+        self.result, self.description, self.rowcount, self.messages = None, None, -1, []
+        self.arraysize = 1
+
+    def execute(self, statement, parameters=None):
+        # statement is a text or a statement returned by Connection.prepare, parameters are values of its '?' in order
+        self.connection.check_open()
+        self.close()
+        if isinstance(statement, Statement):
+            result = self.connection.session.execute_prepared(statement, parameters or [])
+        else:
+            result = self.connection.session.execute(statement, parameters)
+        self.result, self.rowcount, self.messages = result, result.rowcount, result.messages
+        if result.columns is not None:
+            self.description = [(column, None, None, None, None, None, None) for column in result.columns]
+        return self
+
+    def executemany(self, statement, seq_of_parameters):
+        # Statement is prepared once and executed for each sequence of values
+        if not isinstance(statement, Statement):
+            statement = self.connection.prepare(statement)
+        rowcount = 0
+        for parameters in seq_of_parameters:
+            rowcount += self.execute(statement, parameters).rowcount
+        self.rowcount = rowcount
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Rows are read under shared schema lock, so that schema statements of other sessions
+        # do not close the files they are read from
+        with self.connection.session.database.schema_lock.shared():
+            return self.next_row()
+
+    def next_row(self):
+        if self.result is None or self.result.rows is None:
+            raise InterfaceError("Statement has no rows to fetch")
+        try:
+            return tuple(next(self.result.rows))
+        except (db.DBError, OSError, csv.Error) as error:
+            raise typed_error(error) from None
+        except StopIteration:
+            if self.result.discarded and not self.result.exhausted:
+                raise InterfaceError("Rows are discarded by a later statement of the connection") from None
+            self.result.exhausted = True
+            self.result.finish()
+            raise
+
+    def fetchone(self):
+        return next(self, None)
+
+    def fetchmany(self, size=None):
+        with self.connection.session.database.schema_lock.shared():
+            return list(islice(iter(self.next_row, None), size or self.arraysize))
+
+    def fetchall(self):
+        with self.connection.session.database.schema_lock.shared():
+            return list(iter(self.next_row, None))
+
+    def close(self):
+        if self.result is not None:
+            self.result.discard()
+        self.result, self.description, self.rowcount, self.messages = None, None, -1, []
+
+
+def connect():
+    # Open a connection to the database in DB directory of the working directory
+    return Connection()
+
+
+def load_parser():
+    # Grammar and its analyzed tables are found next to this file, so the module works from any directory
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(directory, 'grammar.lark')) as file:
+        return Lark(file.read(), start="command", parser="lalr", lexer="contextual", cache=os.path.join(directory, parser_cache_path))
+
+
+def acquire_database():
+    # First connection of the process loads the parser, migrates old tables and opens the environment
+    global sql_parser, database, database_users
+    if sql_parser is None:
+        sql_parser = load_parser()
+    if database is None:
+        migrate_tables()
+        database = Database(open_environment())
+    database_users += 1
+    return database
+
+
+def release_database():
+    global database, database_users
+    database_users -= 1
+    if database_users == 0:
+        database.close()
+        database = None
+
+
+def print_result(cursor, sink, file):
+    # Messages are printed, rows are written by the sink to the file
+    for message in cursor.messages:
+        print(f"{prompt_msg}{message}")
+    if cursor.description is not None:
+        sink(cursor, [column[0] for column in cursor.description], cursor.result.printer, file)
+        file.flush()
+
+
+async def serve(host, port, socket_path):
+    # Each client gets a connection of its own and sends statements terminated by ';' over a line protocol.
+    # Statements run in a thread of the client, so that the database locks decide which of them run together.
+    # A client waiting for a lock blocks only its own thread, never the client holding the lock
+    loop = asyncio.get_running_loop()
+
+    async def handle_client(reader, writer):
+        executor = ThreadPoolExecutor(1)
+        connection = Connection()
+        cursor = connection.cursor()
+        text = ""
+        try:
+            while line := await reader.readline():
+                *queries, text = (text + line.decode()).split(';')
+                for query in queries:
+                    if not await respond(executor, cursor, query, writer):
+                        return
+        finally:
+            await loop.run_in_executor(executor, connection.close)
+            executor.shutdown()
+            writer.close()
+
+    async def respond(executor, cursor, query, writer):
+        # Send a JSON object per line: columns, then a row per line, then rowcount and messages.
+        # Failed statement sends error instead. Return False when the client exits
+        def send(response):
+            writer.write((json.dumps(response, default=str) + '\n').encode())
+        def execute():
+            # Commit of the statement is on disk before the client is told about it
+            cursor.execute(query + ';')
+            cursor.connection.session.flush()
+        try:
+            await loop.run_in_executor(executor, execute)
+            if cursor.description is not None:
+                send({'columns': [column[0] for column in cursor.description]})
+                while rows := await loop.run_in_executor(executor, cursor.fetchmany, server_fetch_size):
+                    for row in rows:
+                        send({'row': row})
+                    await writer.drain()
+            send({'rowcount': cursor.rowcount, 'messages': cursor.messages})
+        except SystemExit:
+            return False
+        except Exception as error:
+            send({'error': type(error).__name__, 'message': str(error)})
+        finally:
+            cursor.close()
+        await writer.drain()
+        return True
+
+    # Database stays open while no client is connected
+    acquire_database()
+    if socket_path:
+        server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    else:
+        server = await asyncio.start_server(handle_client, host, port)
+    print(f"{prompt_msg}Serving on {socket_path or f'{host}:{port}'}", flush=True)
     try:
-        query = before_query + input(prompt_msg) + ' '
-        sem_idx = query.rfind(';') # Index of last ';'
-        before_query = query[sem_idx + 1:] # Substring after last ';'
-
-        # If has finished query(s)
-        if sem_idx != -1:
-            queries = query[:sem_idx].split(';')
-            for query in queries:
-                output = sql_parser.parse(query + ';')
-                transformer = MyTransformer()
-                transformer.transform(output)
-
-    # When query is exit; or EXIT;
-    except SystemExit:
-        exit(0)
-        
-    # When query has syntax error
-    except exceptions.UnexpectedInput:
-        print(f"{prompt_msg}Syntax error")
+        async with server:
+            await server.serve_forever()
+    finally:
+        release_database()
+
+
+def main():
+    global slow_query_threshold, slow_query_log_path, metrics_dump_path
+    arguments = argparse.ArgumentParser(description="SQL database on BerkeleyDB")
+    arguments.add_argument('--serve', action='store_true', help="accept clients over the network instead of reading standard input")
+    arguments.add_argument('--host', default=server_host)
+    arguments.add_argument('--port', type=int, default=server_port)
+    arguments.add_argument('--socket', help="path of Unix socket to listen on instead of host and port")
+    arguments.add_argument('--slow-query-threshold', type=float, default=slow_query_threshold, help="seconds from which statements are logged")
+    arguments.add_argument('--slow-query-log', default=slow_query_log_path, help="file slow statements are appended to")
+    arguments.add_argument('--metrics-dump', default=metrics_dump_path, help="file totals of statements are written to")
+    arguments.add_argument('--format', choices=list(output_sinks), default='table', help="how the REPL writes rows")
+    arguments.add_argument('--output', help="file the REPL writes rows to instead of standard output")
+    options = arguments.parse_args()
+    slow_query_threshold, slow_query_log_path, metrics_dump_path = options.slow_query_threshold, options.slow_query_log, options.metrics_dump
+    # Database which cannot be opened, e.g. a table failing migration, ends the program with the error
+    try:
+        if options.serve:
+            try:
+                asyncio.run(serve(options.host, options.port, options.socket))
+            except KeyboardInterrupt:
+                pass
+        elif options.output:
+            with open(options.output, 'w', newline='') as file:
+                repl(output_sinks[options.format], file)
+        else:
+            repl(output_sinks[options.format], sys.stdout)
+    except Error as error:
+        print(f"{prompt_msg}{error}")
+        sys.exit(1)
 
-    
\ No newline at end of file
+
+def repl(sink, file):
+    # REPL reads statements terminated by ';' and prints their results, rows are written by the sink to the file
+    connection = connect()
+    cursor = connection.cursor()
+    before_query = ""
+    try:
+        while True:
+            try:
+                query = before_query + input(prompt_msg) + ' '
+            except EOFError:
+                break
+            sem_idx = query.rfind(';') # Index of last ';'
+            before_query = query[sem_idx + 1:] # Substring after last ';'
+
+            # If has finished query(s)
+            if sem_idx != -1:
+                queries = query[:sem_idx].split(';')
+                for query in queries:
+                    try:
+                        print_result(cursor.execute(query + ';'), sink, file)
+                    except Error as error:
+                        print(f"{prompt_msg}{error}")
+                    cursor.close()
+
+            # Statements committed by the line are on disk before the next line is read
+            connection.session.flush()
+
+    # When query is exit; or EXIT;, or the user interrupts
+    except (SystemExit, KeyboardInterrupt):
+        pass
+    finally:
+        # Closing flushes the log of committed statements and closes the environment
+        connection.close()
+
+if __name__ == '__main__':
+    main()
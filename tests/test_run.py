@@ -0,0 +1,188 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+from berkeleydb import db
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run
+
+
+@pytest.fixture
+def connect(tmp_path, monkeypatch):
+    # Database of each test lives in DB directory of a new working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'DB').mkdir()
+    connections = []
+
+    def connect():
+        connections.append(run.connect())
+        return connections[-1]
+    yield connect
+    for connection in connections:
+        connection.close()
+
+
+def rows(connection, text, parameters=None):
+    return list(connection.execute(text, parameters))
+
+
+def write_format_1_table(table_name, columns, primary_key, rows):
+    # Table as the first version wrote it: schema of column types and a hash file keyed by
+    # the 'COLUMN' separated row text. columns are (name, type) with char types written as 'char5'
+    metaDB = db.DB()
+    metaDB.open(f'DB/{table_name}_schema.db', dbtype=db.DB_HASH, flags=db.DB_CREATE)
+    for column_name, column_type in columns:
+        metaDB.put(column_name.encode(), column_type.encode())
+    metaDB.put(b'column_names', 'COLUMN'.join(column_name for column_name, _ in columns).encode())
+    metaDB.put(b'not_null', 'COLUMN'.join(primary_key).encode())
+    metaDB.put(b'primary_key', 'COLUMN'.join(primary_key).encode())
+    metaDB.put(b'reference_count', b'0')
+    metaDB.put(b'foreign_key', b'')
+    metaDB.close()
+    tableDB = db.DB()
+    tableDB.open(f'DB/{table_name}.db', dbtype=db.DB_HASH, flags=db.DB_CREATE)
+    for row in rows:
+        tableDB.put('COLUMN'.join(row).encode(), b'')
+    tableDB.close()
+
+
+def test_migrate_format_1_table(connect):
+    write_format_1_table('person', [('id', 'int'), ('name', 'char5'), ('born', 'date')], ['id'],
+                         [('2', 'bob', '2001-02-03'), ('1', 'amy', 'null'), ('3', 'null', '1999-12-31')])
+    connection = connect()
+    assert rows(connection, "select * from person") == [(1, 'amy', None), (2, 'bob', date(2001, 2, 3)), (3, None, date(1999, 12, 31))]
+    assert rows(connection, "select name from person where id = 2") == [('bob',)]
+    with pytest.raises(run.IntegrityError):
+        connection.execute("insert into person values (1, 'dup', null)")
+
+
+def test_migrate_duplicate_primary_key_keeps_old_table(connect):
+    write_format_1_table('person', [('id', 'int'), ('name', 'char5')], ['id'], [('1', 'amy'), ('1', 'bob'), ('2', 'cal')])
+    with pytest.raises(run.OperationalError, match=r"duplicate primary key \(1\)"):
+        connect()
+    assert not os.path.exists('DB/person.db.migrating')
+    tableDB = db.DB()
+    tableDB.open('DB/person.db', dbtype=db.DB_HASH)
+    assert len(tableDB.keys()) == 3
+    tableDB.close()
+
+
+@pytest.mark.parametrize('text', ['2021-02-30', '2020-13-45'])
+def test_migrate_invalid_date(connect, text):
+    write_format_1_table('event', [('id', 'int'), ('day', 'date')], ['id'], [('1', '2020-01-01'), ('2', text)])
+    with pytest.raises(run.OperationalError, match=f"'{text}' in column 'day'"):
+        connect()
+
+
+def test_migrate_int_out_of_range(connect):
+    write_format_1_table('big', [('id', 'int')], ['id'], [(str(1 << 63),)])
+    with pytest.raises(run.OperationalError, match="column 'id'"):
+        connect()
+
+
+def test_failed_statement_is_rolled_back_inside_transaction(connect):
+    connection = connect()
+    connection.execute("create table t (id int, primary key (id))")
+    connection.execute("begin")
+    connection.execute("insert into t values (1)")
+    with pytest.raises(run.IntegrityError):
+        connection.execute("insert into t values (0), (1)")
+    connection.execute("delete from t where id = 1")
+    connection.execute("insert into t values (3)")
+    connection.execute("rollback")
+    assert rows(connection, "select * from t") == []
+
+    connection.execute("begin")
+    connection.execute("insert into t values (1)")
+    with pytest.raises(run.IntegrityError):
+        connection.execute("insert into t values (0), (1)")
+    connection.execute("commit")
+    assert rows(connection, "select * from t") == [(1,)]
+
+
+def test_load_data_failure_inserts_nothing(connect, tmp_path):
+    connection = connect()
+    connection.execute("create table t (id int, name char(5))")
+    (tmp_path / 'bad.csv').write_bytes(b'1,a\n2,b\n3,\xff\n')
+    with pytest.raises(run.DataError, match="line 3"):
+        connection.execute("load data 'bad.csv' into t")
+    (tmp_path / 'long.csv').write_text('1,' + 'x' * 200000 + '\n')
+    with pytest.raises(run.DataError):
+        connection.execute("load data 'long.csv' into t")
+    assert rows(connection, "select * from t") == []
+
+
+@pytest.fixture
+def parent_child(connect):
+    connection = connect()
+    connection.execute("create table parent (id int, primary key (id))")
+    connection.execute("create table child (id int, pid int, primary key (id), foreign key (pid) references parent (id))")
+    connection.execute("insert into parent values (1), (2), (3)")
+    connection.execute("insert into child values (10, 1), (11, 1), (12, null)")
+    return connection
+
+
+def test_foreign_key_insert(parent_child):
+    with pytest.raises(run.IntegrityError):
+        parent_child.execute("insert into child values (13, 4)")
+    with pytest.raises(run.IntegrityError):
+        parent_child.execute("insert into child values (13, 2), (14, 5)")
+    assert parent_child.execute("insert into child values (13, 2), (14, null)").rowcount == 2
+    assert rows(parent_child, "select id from child where pid = 2") == [(13,)]
+
+
+def test_foreign_key_delete(parent_child):
+    cursor = parent_child.execute("delete from parent where id < 3")
+    assert cursor.rowcount == 1
+    assert "1 row(s) are not deleted due to referential integrity" in cursor.messages
+    assert rows(parent_child, "select id from parent") == [(1,), (3,)]
+    parent_child.execute("delete from child where pid = 1")
+    assert parent_child.execute("delete from parent").rowcount == 2
+
+
+def test_foreign_key_update(parent_child):
+    with pytest.raises(run.IntegrityError):
+        parent_child.execute("update child set pid = 4 where id = 10")
+    assert parent_child.execute("update child set pid = 3 where id = 10").rowcount == 1
+    cursor = parent_child.execute("update parent set id = 5 where id < 3")
+    assert cursor.rowcount == 1
+    assert "1 row(s) are not updated due to referential integrity" in cursor.messages
+    assert rows(parent_child, "select * from parent") == [(1,), (3,), (5,)]
+
+
+def test_snapshot_reads_during_concurrent_write(connect):
+    reader, writer = connect(), connect()
+    reader.execute("create table t (id int, primary key (id))")
+    reader.execute("insert into t values " + ", ".join(f"({i})" for i in range(0, 100, 2)))
+
+    # Rows of an open result are read in the snapshot of the statement
+    cursor = reader.execute("select id from t")
+    first = cursor.fetchone()
+    writer.execute("insert into t values (1), (99)")
+    writer.execute("delete from t where id = 50")
+    assert [first] + cursor.fetchall() == [(i,) for i in range(0, 100, 2)]
+
+    # Statements of a transaction read the snapshot of its start
+    reader.execute("begin")
+    assert len(rows(reader, "select id from t")) == 51
+    writer.execute("insert into t values (3)")
+    assert len(rows(reader, "select id from t")) == 51
+    reader.execute("commit")
+    assert len(rows(reader, "select id from t")) == 52
+
+
+def test_parallel_scan_reads_statement_snapshot(connect, monkeypatch):
+    monkeypatch.setattr(run, 'scan_parallelism', 2)
+    monkeypatch.setattr(run, 'parallel_scan_min_size', 0)
+    reader, writer = connect(), connect()
+    reader.execute("create table t (id int, primary key (id))")
+    reader.execute("insert into t values " + ", ".join(f"({i})" for i in range(0, 2000, 2)))
+    assert rows(reader, "select id from t where id >= 1000") == [(i,) for i in range(1000, 2000, 2)]
+
+    cursor = reader.execute("select id from t")
+    first = cursor.fetchone()
+    writer.execute("insert into t values " + ", ".join(f"({i})" for i in range(1, 2000, 2)))
+    assert [first] + cursor.fetchall() == [(i,) for i in range(0, 2000, 2)]
+    assert len(rows(reader, "select id from t")) == 2000